@@ -0,0 +1,187 @@
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import scipy
+
+from benchmarks import synthetic
+from netcdf.npy_to_nc import copy_dataset_structure, fill_dataset
+from src.cloudsat import get_cloud_occurrences
+from src.interpolation import fill_all_channels
+from src.modis_level2 import decode_cloud_mask
+from src.track_alignment import get_track_oi, gather_track, map_labels, find_track_range
+
+'''Times the hot paths of the pipeline on synthetic granules of several sizes. Each result is printed (and optionally
+appended to a file) as one JSON line tagged with the git commit, so that runs can be compared across commits:
+
+    python -m benchmarks.hot_paths --heights 510 1020 2040 --output bench.jsonl
+'''
+
+NC_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "netcdf", "datasetstr.nc")
+
+def get_commit():
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], stderr=subprocess.DEVNULL) != 0
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ("-dirty" if dirty else "")
+
+def make_granule(height, seed=0):
+    """ Builds all synthetic inputs of a granule of the given number of rows """
+
+    swath = synthetic.make_swath(height, seed=seed)
+    cloud_mask, cloud_flag = synthetic.make_cloud_flag(height, seed=seed)
+    cs_latitudes, cs_longitudes = synthetic.make_track(swath[-2], swath[-1], seed=seed)
+    CloudLayerBase, CloudLayerTop = synthetic.make_layers(cs_latitudes.shape[0], seed=seed)
+
+    return {"swath": swath, "cloud_mask": cloud_mask, "cloud_flag": cloud_flag, "cs_latitudes": cs_latitudes, "cs_longitudes": cs_longitudes,
+            "CloudLayerBase": CloudLayerBase, "CloudLayerTop": CloudLayerTop}
+
+# each benchmark takes the granule and returns (prepare, run): prepare() builds fresh arguments outside of the timed section
+def bench_fill_all_channels(granule):
+
+    return lambda: (granule["swath"].copy(),), fill_all_channels
+
+def bench_fill_all_channels_stripes(granule):
+
+    return lambda: (granule["swath"].copy(), "stripes"), fill_all_channels
+
+def bench_get_track_oi(granule):
+
+    args = (granule["cs_latitudes"], granule["cs_longitudes"], granule["swath"][-2], granule["swath"][-1])
+
+    return lambda: args, get_track_oi
+
+def bench_find_track_range(granule):
+
+    args = (granule["cs_latitudes"], granule["cs_longitudes"], granule["swath"][-2], granule["swath"][-1])
+
+    return lambda: args, find_track_range
+
+def bench_get_layer_information(granule):
+
+    args = (granule["CloudLayerBase"], granule["CloudLayerTop"])
+
+    return lambda: args, get_cloud_occurrences
+
+def bench_decode_cloud_mask(granule):
+
+    args = (granule["cloud_mask"], granule["cloud_flag"])
+
+    return lambda: args, decode_cloud_mask
+
+def bench_gather_track(granule):
+
+    _, mapping, rows, cols, _ = get_track_oi(granule["cs_latitudes"], granule["cs_longitudes"], granule["swath"][-2], granule["swath"][-1])
+    cloud_mask = decode_cloud_mask(granule["cloud_mask"], granule["cloud_flag"])
+
+    def gather(swath, cloud_mask, rows, cols):
+        return gather_track(swath, rows, cols), gather_track(cloud_mask, rows, cols)
+
+    return lambda: (granule["swath"], cloud_mask, rows, cols), gather
+
+def bench_map_labels(granule):
+
+    _, mapping, _, _, _ = get_track_oi(granule["cs_latitudes"], granule["cs_longitudes"], granule["swath"][-2], granule["swath"][-1])
+    layer_info = get_cloud_occurrences(granule["CloudLayerBase"], granule["CloudLayerTop"])[:mapping.shape[0]]
+
+    return lambda: (mapping, layer_info, granule["swath"].shape[1:]), map_labels
+
+def bench_nc_write(granule):
+
+    _, mapping, rows, cols, _ = get_track_oi(granule["cs_latitudes"], granule["cs_longitudes"], granule["swath"][-2], granule["swath"][-1])
+    track = gather_track(granule["swath"], rows, cols)
+    cloud_mask_track = gather_track(decode_cloud_mask(granule["cloud_mask"], granule["cloud_flag"]), rows, cols)
+    layer_info = get_cloud_occurrences(granule["CloudLayerBase"], granule["CloudLayerTop"])[:track.shape[1]]
+
+    tmp_dir = tempfile.mkdtemp()
+
+    def write(track, cloud_mask_track, layer_info):
+
+        copy_name = os.path.join(tmp_dir, "A2016001.0000.nc")
+        copy, variables = copy_dataset_structure(NC_TEMPLATE, copy_name, track)
+        fill_dataset(copy, variables, track, layer_info, 0, "001", cloud_mask=cloud_mask_track)
+        copy.close()
+
+        os.remove(copy_name)
+
+    return lambda: (track, cloud_mask_track, layer_info), write
+
+BENCHMARKS = {
+    "fill_all_channels": bench_fill_all_channels,
+    "fill_all_channels_stripes": bench_fill_all_channels_stripes,
+    "get_track_oi": bench_get_track_oi,
+    "find_track_range": bench_find_track_range,
+    "get_layer_information": bench_get_layer_information,
+    "decode_cloud_mask": bench_decode_cloud_mask,
+    "gather_track": bench_gather_track,
+    "map_labels": bench_map_labels,
+    "nc_write": bench_nc_write,
+}
+
+def time_benchmark(prepare, run, repeat):
+    """ Returns the wall times of repeat calls of run(*prepare()) """
+
+    times = []
+
+    for _ in range(repeat):
+
+        args = prepare()
+
+        t1 = time.perf_counter()
+        run(*args)
+        t2 = time.perf_counter()
+
+        times.append(t2 - t1)
+
+    return times
+
+def run_benchmarks(heights, names, repeat=3, seed=0):
+    """ Yields one result dict per (benchmark, height) """
+
+    info = {"commit": get_commit(), "python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__}
+
+    for height in heights:
+
+        granule = make_granule(height, seed=seed)
+
+        for name in names:
+
+            prepare, run = BENCHMARKS[name](granule)
+            times = time_benchmark(prepare, run, repeat)
+
+            result = {"benchmark": name, "height": height, "width": synthetic.MAX_WIDTH, "repeat": repeat,
+                      "min": min(times), "median": float(np.median(times)), "times": times}
+            result.update(info)
+
+            yield result
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the pipeline hot paths on synthetic granules")
+    parser.add_argument("--heights", type=int, nargs="+", default=[510, 1020, synthetic.MAX_HEIGHT], help="swath heights (rows) to benchmark")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON-lines file the results are appended to")
+    args = parser.parse_args()
+
+    for result in run_benchmarks(args.heights, args.only, args.repeat, args.seed):
+
+        line = json.dumps(result)
+        print(line)
+        sys.stdout.flush()
+
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
@@ -0,0 +1,140 @@
+import argparse
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import netCDF4 as nc4
+
+from benchmarks.hot_paths import get_commit
+from netcdf.npy_to_nc import COMPRESSION_PRESETS, get_compression, get_variable_kind
+
+'''Compares the compression presets of the netcdf outputs on real outputs of the pipeline: each file is rewritten with each
+preset, and the write time, the time to read back all its variables, the size and the largest rounding error by kind of
+variable are printed as one JSON line per (file, preset):
+
+    python -m benchmarks.nc_compression --presets zlib quantized --output nc_compression.jsonl <nc_file> [<nc_file> ...]
+
+The rounding errors are relative to the given files, which should be written without quantization.'''
+
+def read_blocks(dataset):
+    """ Returns the dataset and its groups, recursively """
+
+    blocks = [dataset]
+
+    for group in dataset.groups.values():
+        blocks += read_blocks(group)
+
+    return blocks
+
+def rewrite_nc(nc_file, out_file, compression):
+    """ Writes a copy of nc_file whose variables are compressed with the given preset """
+
+    with nc4.Dataset(nc_file, 'r') as original, nc4.Dataset(out_file, 'w', format='NETCDF4') as copy:
+
+        copy.setncatts({a : original.getncattr(a) for a in original.ncattrs()})
+
+        for block in read_blocks(original):
+
+            new_block = copy if block is original else copy.createGroup(block.path)
+            new_block.setncatts({a : block.getncattr(a) for a in block.ncattrs()})
+
+            for name, dim in block.dimensions.items():
+                new_block.createDimension(name, None if dim.isunlimited() else len(dim))
+
+            for name, var in block.variables.items():
+
+                attributes = {a : var.getncattr(a) for a in var.ncattrs()}
+                fill_value = attributes.pop("_FillValue", None)
+
+                new_var = new_block.createVariable(name, var.datatype, var.dimensions, fill_value=fill_value, **get_compression(compression, name, var.datatype))
+                new_var.setncatts(attributes)
+                new_var[:] = var[:]
+
+def read_all(nc_file):
+    """ Returns all the variables of a file, by path """
+
+    with nc4.Dataset(nc_file, 'r') as dataset:
+        return {os.path.join(block.path, name): var[:] for block in read_blocks(dataset) for name, var in block.variables.items()}
+
+def get_errors(reference, values):
+    """ Returns the largest absolute difference by kind of variable """
+
+    errors = {}
+
+    for path, reference_values in reference.items():
+
+        if not np.issubdtype(reference_values.dtype, np.floating):
+            continue
+
+        difference = np.abs(np.ma.filled(values[path], np.nan).astype(np.float64) - np.ma.filled(reference_values, np.nan))
+
+        if np.isnan(difference).all():
+            continue
+
+        kind = get_variable_kind(os.path.basename(path))
+        errors[kind] = max(errors.get(kind, 0.), float(np.nanmax(difference)))
+
+    return errors
+
+def run_benchmarks(nc_files, presets, repeat=3):
+    """ Yields one result dict per (file, preset) """
+
+    info = {"commit": get_commit(), "netcdf4": nc4.__version__}
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for nc_file in nc_files:
+
+            reference = read_all(nc_file)
+
+            for preset in presets:
+
+                out_file = os.path.join(tmp_dir, "{}.nc".format(preset))
+                write_times, read_times = [], []
+
+                for _ in range(repeat):
+
+                    if os.path.exists(out_file):
+                        os.remove(out_file)
+
+                    t1 = time.perf_counter()
+                    rewrite_nc(nc_file, out_file, preset)
+                    t2 = time.perf_counter()
+                    values = read_all(out_file)
+                    t3 = time.perf_counter()
+
+                    write_times.append(t2 - t1)
+                    read_times.append(t3 - t2)
+
+                result = {"file": os.path.basename(nc_file), "preset": preset, "repeat": repeat, "bytes": os.path.getsize(out_file),
+                          "original_bytes": os.path.getsize(nc_file), "write": min(write_times), "read": min(read_times),
+                          "max_error": get_errors(reference, values)}
+                result.update(info)
+
+                yield result
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the netcdf compression presets on outputs of the pipeline")
+    parser.add_argument("nc_files", nargs="+", help="netcdf outputs of the pipeline")
+    parser.add_argument("--presets", nargs="+", choices=sorted(COMPRESSION_PRESETS), default=sorted(COMPRESSION_PRESETS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON-lines file the results are appended to")
+    args = parser.parse_args()
+
+    for result in run_benchmarks(args.nc_files, args.presets, args.repeat):
+
+        line = json.dumps(result)
+        print(line)
+        sys.stdout.flush()
+
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
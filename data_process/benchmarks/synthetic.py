@@ -0,0 +1,151 @@
+import numpy as np
+
+'''Synthetic MODIS swaths and CloudSat tracks, shaped like the real inputs of the pipeline, so that the hot paths can be
+timed offline without HDF4 files.'''
+
+MAX_WIDTH, MAX_HEIGHT = 1354, 2040
+
+# number of detectors (rows) per MODIS 1km scan
+SCAN_ROWS = 10
+
+# channel layout of get_swath: 38 bands, solar zenith angle, latitude and longitude
+NB_SWATH_CHANNELS = 41
+VISIBLE_CHANNELS = list(range(21)) + [27]
+
+# number of profiles in a ~99 minutes CloudSat granule
+GRANULE_PROFILES = 37000
+
+# Aqua band 6 (channel 5) has dead detectors, repeated in every scan
+STRIPED_CHANNELS = {5: [1, 3, 4, 6, 8]}
+
+def make_geolocation(height=MAX_HEIGHT, width=MAX_WIDTH, start_lat=-58., end_lat=-82., start_lon=140., seed=0):
+    """
+    :return latitudes, longitudes: float32 numpy.ndarray of size (height, width), a descending pass over Antarctica
+    The swath centre line follows a meridian-tilted path; cross-track offsets span ~2330 km and widen in longitude towards the pole.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    centre_lat = np.linspace(start_lat, end_lat, height)
+    centre_lon = start_lon + np.linspace(0., 25., height)
+
+    # cross-track offsets in degrees of arc, ~1 km per pixel at nadir, growing towards the swath edges
+    cross = np.linspace(-1., 1., width)
+    offsets = 10.5 * (cross + 0.35 * cross ** 3)
+
+    heading = np.deg2rad(15.)
+
+    latitudes = centre_lat[:, None] + offsets[None, :] * np.sin(heading)
+    longitudes = centre_lon[:, None] + offsets[None, :] * np.cos(heading) / np.cos(np.deg2rad(latitudes))
+
+    latitudes += rng.normal(scale=1e-3, size=latitudes.shape)
+    longitudes = (longitudes + 180.) % 360. - 180.
+
+    return latitudes.astype(np.float32), longitudes.astype(np.float32)
+
+def make_swath(height=MAX_HEIGHT, width=MAX_WIDTH, night=False, nb_gaps=3, seed=0):
+    """
+    :return swath: float32 numpy.ndarray of size (41, height, width), laid out as the output of src.modis_level1.get_swath
+    Radiance channels are smooth random fields with NaN detector stripes (STRIPED_CHANNELS) and a few irregular NaN gaps.
+    At night the visible channels are entirely NaN.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    swath = np.empty((NB_SWATH_CHANNELS, height, width), dtype=np.float32)
+
+    # smooth fields: low resolution noise upsampled to the swath size
+    coarse = rng.rand(NB_SWATH_CHANNELS - 2, height // 40 + 2, width // 40 + 2).astype(np.float32)
+    rows = np.arange(height) // 40
+    cols = np.arange(width) // 40
+    swath[:-2] = coarse[:, rows][:, :, cols] + 0.05 * rng.rand(NB_SWATH_CHANNELS - 2, height, width).astype(np.float32)
+
+    swath[-2], swath[-1] = make_geolocation(height, width, seed=seed)
+
+    for channel, detectors in STRIPED_CHANNELS.items():
+        for detector in detectors:
+            swath[channel, detector::SCAN_ROWS] = np.nan
+
+    for _ in range(nb_gaps):
+        channel = rng.randint(NB_SWATH_CHANNELS - 2)
+        i, j = rng.randint(height), rng.randint(width)
+        swath[channel, i:i + rng.randint(1, 30), j:j + rng.randint(1, 200)] = np.nan
+
+    if night:
+        swath[VISIBLE_CHANNELS] = np.nan
+
+    return swath
+
+def make_cloud_flag(height=MAX_HEIGHT, width=MAX_WIDTH, seed=0):
+    """
+    :return cloud_mask, cloud_flag: the satpy 2-bit cloud mask (height, width) and the 6 bytes of the MYD35 Cloud_Mask SDS (6, height, width) as int8
+    """
+
+    rng = np.random.RandomState(seed)
+
+    cloud_flag = rng.randint(-128, 128, size=(6, height, width)).astype(np.int8)
+    cloud_mask = np.right_shift(np.bitwise_and(cloud_flag[0].astype(np.uint8), 6), 1).astype(np.float32)
+
+    return cloud_mask, cloud_flag
+
+def make_track(swath_latitudes, swath_longitudes, overhang=0.3, step=0.9, nb_profiles=GRANULE_PROFILES, seed=0):
+    """
+    :param swath_latitudes, swath_longitudes: geolocation of the swath the track crosses
+    :param overhang: fraction of the swath length the track extends beyond each end
+    :param step: number of swath rows between consecutive profiles (CloudSat profiles are ~1.1 km apart)
+    :param nb_profiles: total length of the track: the rest of the orbit is padded with profiles far north of the swath
+    :return cs_latitudes, cs_longitudes: numpy.ndarray of size (nb_profiles, 1), as returned by src.cloudsat.get_coordinates
+    The track runs along the swath, slightly oblique, through the swath geolocation.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    height, width = swath_latitudes.shape
+
+    rows = np.arange(-overhang * height, (1 + overhang) * height, step)
+    cols = width * 0.45 + 0.05 * (rows - height / 2)
+
+    # extrapolate the geolocation linearly outside the swath
+    inside_rows = np.clip(rows, 0, height - 1).astype(int)
+    inside_cols = np.clip(cols, 0, width - 1).astype(int)
+
+    d_lat = (swath_latitudes[-1, inside_cols] - swath_latitudes[0, inside_cols]) / (height - 1)
+    d_lon = (swath_longitudes[-1, inside_cols] - swath_longitudes[0, inside_cols]) / (height - 1)
+
+    cs_latitudes = swath_latitudes[inside_rows, inside_cols] + (rows - inside_rows) * d_lat
+    cs_longitudes = swath_longitudes[inside_rows, inside_cols] + (rows - inside_rows) * d_lon
+
+    # rest of the orbit, before and after the swath
+    nb_pad = max(0, nb_profiles - rows.shape[0])
+    pad_latitudes = np.linspace(-40., 80., nb_pad)
+    pad_longitudes = np.linspace(-60., 60., nb_pad)
+
+    cs_latitudes = np.concatenate([pad_latitudes[nb_pad // 2:][::-1], cs_latitudes, pad_latitudes[:nb_pad // 2]])
+    cs_longitudes = np.concatenate([pad_longitudes[nb_pad // 2:][::-1], cs_longitudes, pad_longitudes[:nb_pad // 2]])
+
+    cs_latitudes += rng.normal(scale=2e-3, size=cs_latitudes.shape)
+    cs_longitudes += rng.normal(scale=2e-3, size=cs_longitudes.shape)
+
+    return cs_latitudes[:, None].astype(np.float64), cs_longitudes[:, None].astype(np.float64)
+
+def make_layers(nb_profiles, nb_layers=10, cloud_fraction=0.7, seed=0):
+    """
+    :return CloudLayerBase, CloudLayerTop: numpy.ndarray of size (nb_profiles, nb_layers), in km, -99 after the last layer
+    as read from the 2B-CLDCLASS-LIDAR SDS
+    """
+
+    rng = np.random.RandomState(seed)
+
+    CloudLayerBase = np.full((nb_profiles, nb_layers), -99., dtype=np.float32)
+    CloudLayerTop = np.full((nb_profiles, nb_layers), -99., dtype=np.float32)
+
+    # at most nb_layers - 1 layers, so that every profile ends with a negative value
+    nb_cloud_layers = rng.randint(1, 4, size=nb_profiles) * (rng.rand(nb_profiles) < cloud_fraction)
+
+    for layer in range(3):
+        cloudy = nb_cloud_layers > layer
+        base = rng.uniform(0.2 + 3 * layer, 3. + 3 * layer, size=nb_profiles)
+        CloudLayerBase[cloudy, layer] = base[cloudy]
+        CloudLayerTop[cloudy, layer] = base[cloudy] + rng.uniform(0.1, 2., size=nb_profiles)[cloudy]
+
+    return CloudLayerBase, CloudLayerTop
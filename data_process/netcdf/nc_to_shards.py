@@ -0,0 +1,200 @@
+import json
+import numpy as np
+import os
+import sys
+
+import netCDF4 as nc4
+
+from netcdf.npy_to_nc import swath_channels, layer_info_channels
+
+# number of samples per shard: 2**18 samples of 66 float32 channels is ~70 MB per feature shard
+SHARD_SIZE = 2 ** 18
+
+FEATURES_NAME = "features-{:05d}.npy"
+LABELS_NAME = "labels-{:05d}.npy"
+INDEX_NAME = "index.npy"
+META_NAME = "meta.json"
+
+# one row per sample: shard number, row inside the shard and granule the sample comes from
+index_dtype = np.dtype([("shard", np.uint32), ("offset", np.uint32), ("granule", np.uint32)])
+
+def read_track_nc(nc_file):
+    """
+    :param nc_file: a co-located file written by save_as_nc
+    :return: name of the granule, features numpy.ndarray of size (nb_channels, nb_samples) and labels numpy.ndarray of size (nb_samples,)
+    """
+
+    with nc4.Dataset(nc_file, 'r') as dataset:
+
+        dataset.set_auto_mask(False)
+
+        features = np.stack([dataset.variables[name][0] for name in swath_channels])
+        labels = dataset.variables[layer_info_channels[0]][0]
+
+    return os.path.basename(nc_file), features, labels
+
+def iter_nc_samples(nc_files):
+    """ Yields (granule name, features, labels) for each save_as_nc output """
+
+    for nc_file in nc_files:
+        yield read_track_nc(nc_file)
+
+def _open_shard(out_dir, shard, shard_size, nb_channels):
+
+    features = np.lib.format.open_memmap(os.path.join(out_dir, FEATURES_NAME.format(shard)), mode='w+', dtype=np.float32, shape=(shard_size, nb_channels))
+    labels = np.lib.format.open_memmap(os.path.join(out_dir, LABELS_NAME.format(shard)), mode='w+', dtype=np.uint8, shape=(shard_size,))
+
+    return features, labels
+
+def _truncate_shard(out_dir, shard, size):
+    """ Rewrites the last, partially filled shard with its actual number of samples """
+
+    for name in [FEATURES_NAME, LABELS_NAME]:
+
+        path = os.path.join(out_dir, name.format(shard))
+        full = np.load(path, mmap_mode='r')
+
+        tmp_path = path + ".tmp"
+        truncated = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=full.dtype, shape=(size, *full.shape[1:]))
+        truncated[:] = full[:size]
+        truncated.flush()
+
+        del full, truncated
+        os.replace(tmp_path, path)
+
+def export_shards(samples, out_dir, shard_size=SHARD_SIZE):
+    """
+    :param samples: iterable of (granule name, features, labels), with features of size (nb_channels, nb_samples) as returned by read_track_nc, or a tuple of channel groups as returned by extract_swath_ontrack, and labels of size (nb_samples,) or (nb_samples, 1)
+    :param out_dir: directory in which the shards, the index and the metadata are written
+    :param shard_size: number of samples per shard
+    :return: the sample index, a structured numpy.ndarray with one (shard, offset, granule) row per sample
+    Writes fixed-size .npy shards of features (shard_size, nb_channels) float32 and labels (shard_size,) uint8, so that each sample is a contiguous row readable through np.memmap. Only the last shard is shorter.
+    """
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    granules, index = [], []
+    features, labels = None, None
+    shard, offset, nb_channels = 0, 0, None
+
+    for name, granule_features, granule_labels in samples:
+
+        # channel groups, e.g. the float32 swath and uint8 cloud mask returned by extract_swath_ontrack
+        if isinstance(granule_features, (list, tuple)):
+            granule_features = np.vstack(granule_features)
+
+        granule_labels = np.asarray(granule_labels).ravel()
+        nb_samples = granule_labels.shape[0]
+
+        if nb_channels is None:
+            nb_channels = granule_features.shape[0]
+
+        assert granule_features.shape == (nb_channels, nb_samples), "features and labels of {} do not match".format(name)
+
+        granule_id = len(granules)
+        granules.append(name)
+
+        start = 0
+        while start < nb_samples:
+
+            if features is None:
+                features, labels = _open_shard(out_dir, shard, shard_size, nb_channels)
+
+            stop = min(nb_samples, start + shard_size - offset)
+            count = stop - start
+
+            features[offset:offset + count] = granule_features[:, start:stop].T
+            labels[offset:offset + count] = granule_labels[start:stop]
+
+            granule_index = np.empty(count, dtype=index_dtype)
+            granule_index["shard"] = shard
+            granule_index["offset"] = np.arange(offset, offset + count)
+            granule_index["granule"] = granule_id
+            index.append(granule_index)
+
+            start, offset = stop, offset + count
+
+            # shard is full, move on to the next one
+            if offset == shard_size:
+                features.flush()
+                labels.flush()
+                features, labels = None, None
+                shard, offset = shard + 1, 0
+
+    nb_shards = shard
+
+    if features is not None:
+        features.flush()
+        labels.flush()
+        del features, labels
+        _truncate_shard(out_dir, shard, offset)
+        nb_shards += 1
+
+    index = np.concatenate(index) if len(index) > 0 else np.empty(0, dtype=index_dtype)
+    np.save(os.path.join(out_dir, INDEX_NAME), index, allow_pickle=False)
+
+    meta = {
+        "shard_size": shard_size,
+        "nb_shards": nb_shards,
+        "nb_samples": int(index.shape[0]),
+        "channels": swath_channels if nb_channels == len(swath_channels) else list(range(nb_channels or 0)),
+        "granules": granules,
+    }
+
+    with open(os.path.join(out_dir, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return index
+
+def load_shards(out_dir):
+    """
+    :param out_dir: directory written by export_shards
+    :return: lists of read-only memory-mapped feature and label shards, the sample index and the metadata dict
+    Nothing is read from disk until samples are accessed.
+    """
+
+    with open(os.path.join(out_dir, META_NAME)) as f:
+        meta = json.load(f)
+
+    features = [np.load(os.path.join(out_dir, FEATURES_NAME.format(i)), mmap_mode='r') for i in range(meta["nb_shards"])]
+    labels = [np.load(os.path.join(out_dir, LABELS_NAME.format(i)), mmap_mode='r') for i in range(meta["nb_shards"])]
+    index = np.load(os.path.join(out_dir, INDEX_NAME), mmap_mode='r')
+
+    return features, labels, index, meta
+
+def shuffle_index(index, seed=None):
+    """ Returns a shuffled copy of the sample index: an epoch-level shuffle without touching the shards """
+
+    return index[np.random.RandomState(seed).permutation(index.shape[0])]
+
+def get_samples(features, labels, index_rows):
+    """
+    :param features, labels: shards as returned by load_shards
+    :param index_rows: a slice of the (possibly shuffled) sample index
+    :return: features numpy.ndarray of size (nb_rows, nb_channels) and labels of size (nb_rows,), in the order of index_rows
+    """
+
+    nb_rows = index_rows.shape[0]
+    batch_features = np.empty((nb_rows, features[0].shape[1]), dtype=features[0].dtype)
+    batch_labels = np.empty(nb_rows, dtype=np.uint8)
+
+    for shard in np.unique(index_rows["shard"]):
+
+        rows = np.where(index_rows["shard"] == shard)[0]
+        offsets = index_rows["offset"][rows]
+
+        batch_features[rows] = features[shard][offsets]
+        batch_labels[rows] = labels[shard][offsets]
+
+    return batch_features, batch_labels
+
+if __name__ == "__main__":
+
+    # python -m netcdf.nc_to_shards <out_dir> <nc_file> [<nc_file> ...]
+    out_dir = sys.argv[1]
+    nc_files = sorted(sys.argv[2:])
+
+    index = export_shards(iter_nc_samples(nc_files), out_dir)
+
+    print("{} samples from {} files exported to {}".format(index.shape[0], len(nc_files), out_dir))
@@ -4,14 +4,81 @@ import sys
 
 import netCDF4 as nc4
 
-from src.utils import get_datetime, get_file_time_info, minutes_since    
+from src.cloudsat import load_layer_info
+from src.track_alignment import gather_track
+from src.utils import FLAG_DTYPE, get_datetime, get_file_time_info, minutes_since    
 
 swath_channels = ['ev_250_aggr1km_refsb_1', 'ev_250_aggr1km_refsb_2', 'ev_500_aggr1km_refsb_3', 'ev_500_aggr1km_refsb_4', 'ev_500_aggr1km_refsb_5', 'ev_500_aggr1km_refsb_6', 'ev_500_aggr1km_refsb_7', 'ev_1km_refsb_8', 'ev_1km_refsb_9', 'ev_1km_refsb_10', 'ev_1km_refsb_11', 'ev_1km_refsb_12', 'ev_1km_refsb_13L', 'ev_1km_refsb_13H', 'ev_1km_refsb_14L', 'ev_1km_refsb_14H', 'ev_1km_refsb_15', 'ev_1km_refsb_16', 'ev_1km_refsb_17', 'ev_1km_refsb_18', 'ev_1km_refsb_19',   'ev_1km_emissive_20', 'ev_1km_emissive_21', 'ev_1km_emissive_22', 'ev_1km_emissive_23', 'ev_1km_emissive_24', 'ev_1km_emissive_25', 'ev_1km_refsb_26', 'ev_1km_emissive_27', 'ev_1km_emissive_28', 'ev_1km_emissive_29', 'ev_1km_emissive_30', 'ev_1km_emissive_31', 'ev_1km_emissive_32', 'ev_1km_emissive_33', 'ev_1km_emissive_34', 'ev_1km_emissive_35', 'ev_1km_emissive_36', 'solar_zenith_angle','latitude', 'longitude','cloud_mask', 'Bit4', 'Bit5', 'Bit6_7', 'Bit8', 'Bit9', 'Bit10', 'Bit11', 'Bit12', 'Bit13', 'Bit14', 'Bit15', 'Bit16', 'Bit17', 'Bit18', 'Bit19', 'Bit20', 'Bit21', 'Bit22', 'Bit23', 'Bit24', 'Bit25', 'Bit26', 'Bit27', 'Bit28']
 
 layer_info_channels = ['cloud_occurrences']
 
-def copy_dataset_structure(original_filename, copy_filename, swath, deep=True, zlib=True):
+# the swath channels are written from two groups: float32 radiances and geolocation, and uint8 cloud mask flags
+radiance_channels = swath_channels[:41]
+cloud_mask_channels = swath_channels[41:]
+
+# compression of the written variables by kind of variable (see get_variable_kind): keyword arguments of netCDF4's createVariable,
+# "default" applying to the kinds not listed. least_significant_digit rounds the floats to that decimal, which leaves runs of zero
+# bits that the shuffle filter and zlib compress well: reflectances are in %, brightness temperatures in K and angles in degrees
+COMPRESSION_PRESETS = {
+    "none": {"default": {"zlib": False}},
+    # zlib at the default level on every variable
+    "zlib": {"default": {"zlib": True}},
+    "lossless": {"default": {"zlib": True, "complevel": 4, "shuffle": True}},
+    # rounding below the noise of the MODIS bands (0.01 % reflectance, 0.01 K), and to ~1 m for the geolocation
+    "quantized": {"default": {"zlib": True, "complevel": 4, "shuffle": True},
+                  "reflectance": {"zlib": True, "complevel": 4, "shuffle": True, "least_significant_digit": 2},
+                  "brightness_temperature": {"zlib": True, "complevel": 4, "shuffle": True, "least_significant_digit": 2},
+                  "geolocation": {"zlib": True, "complevel": 4, "shuffle": True, "least_significant_digit": 5}},
+    "quantized_coarse": {"default": {"zlib": True, "complevel": 6, "shuffle": True},
+                         "reflectance": {"zlib": True, "complevel": 6, "shuffle": True, "least_significant_digit": 1},
+                         "brightness_temperature": {"zlib": True, "complevel": 6, "shuffle": True, "least_significant_digit": 1},
+                         "geolocation": {"zlib": True, "complevel": 6, "shuffle": True, "least_significant_digit": 4}},
+}
+
+DEFAULT_COMPRESSION = "zlib"
+
+def get_variable_kind(name):
+    """ Returns the kind of a variable, the key of its compression in a preset: "reflectance", "brightness_temperature", "geolocation", "flag" or "default" """
+
+    if "refsb" in name:
+        return "reflectance"
+
+    if "emissive" in name:
+        return "brightness_temperature"
+
+    if name in ["latitude", "longitude", "solar_zenith_angle"]:
+        return "geolocation"
+
+    if name in cloud_mask_channels:
+        return "flag"
+
+    return "default"
+
+def get_compression(compression, name, datatype):
+    """
+    :param compression: name of a COMPRESSION_PRESETS, or a preset dict
+    :param datatype: the datatype the variable is created with; integers are never quantized
+    :return: the createVariable keyword arguments of the variable
+    """
+
+    if not isinstance(compression, dict):
+        compression = COMPRESSION_PRESETS[compression]
+
+    kwargs = dict(compression.get(get_variable_kind(name), compression.get("default", {})))
+
+    if not np.issubdtype(np.dtype(datatype), np.floating):
+        kwargs.pop("least_significant_digit", None)
+
+    return kwargs
+
+def copy_dataset_structure(original_filename, copy_filename, swath, deep=True, zlib=True, compression=None):
+    """
+    :param compression: name of a COMPRESSION_PRESETS or preset dict; None compresses all variables with zlib if zlib is set
+    """
     
+    if compression is None:
+        compression = DEFAULT_COMPRESSION if zlib else "none"
+
     with nc4.Dataset(original_filename, 'r') as original:
 
         copy = nc4.Dataset(copy_filename, 'w', format='NETCDF4')
@@ -40,24 +107,41 @@ def copy_dataset_structure(original_filename, copy_filename, swath, deep=True, z
             # Copy variables
             for name, var in block.variables.items():
 
-                new_var = new_block.createVariable(name, var.datatype, var.dimensions, zlib=zlib)
+                datatype = var.datatype
+                attributes = {a : var.getncattr(a) for a in var.ncattrs()}
+
+                # flags and categorical masks only hold small integers, store them as bytes
+                if name in cloud_mask_channels:
+                    datatype = FLAG_DTYPE
+                    if "valid_range" in attributes:
+                        attributes["valid_range"] = np.asarray(attributes["valid_range"]).astype(FLAG_DTYPE)
+
+                new_var = new_block.createVariable(name, datatype, var.dimensions, **get_compression(compression, name, datatype))
                 
                 # Copy variable attributes
-                new_var.setncatts({a : var.getncattr(a) for a in var.ncattrs()})
+                new_var.setncatts(attributes)
 
                 variables[name] = new_var
 
     return copy, variables
 
-def fill_dataset(dataset, variables, swath, layer_info, minutes, abs_day, status="daylight", deep=True):
+def fill_dataset(dataset, variables, swath, layer_info, minutes, abs_day, status="daylight", deep=True, cloud_mask=None):
+    """
+    :param swath: numpy.ndarray of size (66, nb_pixels), or of size (41, nb_pixels) if cloud_mask is given
+    :param cloud_mask: optional uint8 numpy.ndarray of size (25, nb_pixels), the cloud mask channels kept apart from the float swath
+    """
 
     shape = swath[0].shape
-    print("shape", shape, swath.shape)
 
+    if cloud_mask is None:
+        channel_groups = [(swath_channels, swath)]
+    else:
+        channel_groups = [(radiance_channels, swath), (cloud_mask_channels, cloud_mask)]
 
-    for i, channel in enumerate(swath_channels):
+    for channels, group in channel_groups:
+        for i, channel in enumerate(channels):
 
-        variables[channel][0] = swath[i]
+            variables[channel][0] = group[i]
         
    
 
@@ -72,21 +156,112 @@ def fill_dataset(dataset, variables, swath, layer_info, minutes, abs_day, status
     dataset["time"][0] = minutes
     dataset["dayofyear"][0] = abs_day
     
-def load_npys(swath_path, layer_info_dir="layer-info"):
+def add_strip(dataset, variables, strip, compression=DEFAULT_COMPRESSION):
+    """
+    Writes the cross-track strip of the neighbourhoods of the track pixels (see pipeline.new_track_strip) in a "strip" group, once:
+    a variable per swath channel over the strip rows and columns, and the offsets of the patch of each track pixel, along the track.
+    The patches are read back with read_strip.
+    """
+
+    group = dataset.createGroup("strip")
+
+    group.createDimension("row", strip["swath"].shape[1])
+    group.createDimension("col", strip["swath"].shape[2])
+
+    first_row, last_row, first_col, last_col = strip["range"]
+    group.setncatts({"patch_size": strip["patch_size"], "first_row": first_row, "first_col": first_col,
+                     "description": "swath pixels around the track; the patch of track pixel i is the patch_size x patch_size window "
+                                    "starting at (row_offset[i], col_offset[i])"})
+
+    for channels, channel_strip in [(radiance_channels, strip["swath"]), (cloud_mask_channels, strip["cloud_mask"])]:
+        for i, channel in enumerate(channels):
+
+            attributes = {a : variables[channel].getncattr(a) for a in variables[channel].ncattrs()}
+
+            new_var = group.createVariable(channel, channel_strip.dtype, ("row", "col"), **get_compression(compression, channel, channel_strip.dtype))
+            new_var.setncatts(attributes)
+            new_var[:] = channel_strip[i]
+
+    for name, offsets in [("row_offset", strip["row_offsets"]), ("col_offset", strip["col_offsets"])]:
+
+        new_var = group.createVariable(name, np.int32, ("track",), **get_compression(compression, name, np.int32))
+        new_var[:] = offsets
+
+def read_strip(dataset):
+    """ Returns the strip written by add_strip as a dict, as pipeline.new_track_strip, or None if the dataset has none """
+
+    if "strip" not in dataset.groups:
+        return None
+
+    group = dataset.groups["strip"]
+
+    strip = {"swath": np.stack([group[channel][:].filled(np.nan) for channel in radiance_channels]),
+             "cloud_mask": np.stack([np.asarray(group[channel][:]) for channel in cloud_mask_channels]),
+             "patch_size": int(group.patch_size), "row_offsets": np.asarray(group["row_offset"][:]), "col_offsets": np.asarray(group["col_offset"][:])}
+
+    strip["range"] = (int(group.first_row), int(group.first_row) + strip["swath"].shape[1], int(group.first_col), int(group.first_col) + strip["swath"].shape[2])
+
+    return strip
+
+def load_npys(swath_path, layer_info_dir="layer-info", cloud_mask_dir="cloud-mask", mmap_mode='r'):
+    """
+    :param layer_info_dir: subdirectory of the layer info, None not to load it
+    :param mmap_mode: the swath and cloud mask are opened as read-only memory maps by default, so that only the slices used are read from disk; None loads them in memory
+    :return: the swath (41, HEIGHT, WIDTH), the layer info (see src.cloudsat.load_layer_info) and the cloud mask (25, HEIGHT, WIDTH), None if they were not saved
+    """
 
     dirname, filename = os.path.split(swath_path)
 
-    swath = np.load(swath_path)
+    swath = np.load(swath_path, mmap_mode=mmap_mode)
 
     try:
-        layer_info_dict = np.load(os.path.join(dirname, layer_info_dir, filename)).item()
+        cloud_mask = np.load(os.path.join(dirname, cloud_mask_dir, filename), mmap_mode=mmap_mode)
 
     except FileNotFoundError:
-        layer_info_dict = None
+        cloud_mask = None
+
+    layer_info = None
+
+    if layer_info_dir is not None:
+
+        # layer infos saved before the .npz format are .npy files
+        for layer_info_path in [os.path.join(dirname, layer_info_dir, filename.replace(".npy", ".npz")), os.path.join(dirname, layer_info_dir, filename)]:
+            if os.path.exists(layer_info_path):
+                layer_info = load_layer_info(layer_info_path)
+                break
+
+    return swath, layer_info, cloud_mask
+
+def gather_npys(swath_path, rows, cols, cloud_mask_dir="cloud-mask"):
+    """
+    :param rows, cols: swath indices of the co-located pixels, as returned by src.track_alignment.get_track_oi
+    :return: the swath (41, nb_pixels) and cloud mask (25, nb_pixels, None if it was not saved) values along the track, read from the saved npys
+    Only the pages of the memory-mapped npys holding track pixels are read.
+    """
+
+    swath, _, cloud_mask = load_npys(swath_path, layer_info_dir=None, cloud_mask_dir=cloud_mask_dir)
+
+    return gather_track(swath, rows, cols), None if cloud_mask is None else gather_track(cloud_mask, rows, cols)
+
+def save_quicklook(swath_path, png_path, channels=(0, 3, 2), step=4, max_reflectance=1.):
+    """
+    Saves a subsampled RGB png of a saved swath, by default bands 1, 4 and 3 (true colour), one pixel in step along both axes
+    Only the three channels are read from the memory-mapped npy; night swaths are black.
+    """
 
-    return swath, layer_info_dict
+    from PIL import Image
 
-def save_as_nc(swath, layer_info, swath_path, save_name):
+    swath = np.load(swath_path, mmap_mode='r')
+
+    rgb = np.stack([swath[channel, ::step, ::step] for channel in channels], axis=-1)
+    rgb = np.nan_to_num(np.clip(rgb / max_reflectance, 0., 1.) * 255, nan=0.).astype(np.uint8)
+
+    Image.fromarray(rgb).save(png_path)
+
+def save_as_nc(swath, layer_info, swath_path, save_name, cloud_mask=None, strip=None, compression=DEFAULT_COMPRESSION):
+    """
+    :param compression: name of a COMPRESSION_PRESETS, or a preset dict
+    """
         
     path = '/Users/apple/Antarctic_sea_ice/data_processing/'
     
@@ -94,7 +269,7 @@ def save_as_nc(swath, layer_info, swath_path, save_name):
         
         #copy, variables = copy_dataset_structure(os.path.join(path,"netcdf","datasetstr2.nc"), save_name)
     #else:
-    copy, variables = copy_dataset_structure(os.path.join(path,"netcdf","datasetstr.nc"), save_name, swath)
+    copy, variables = copy_dataset_structure(os.path.join(path,"netcdf","datasetstr.nc"), save_name, swath, compression=compression)
 
     # determine swath status from directory hierarchy
     status = "corrupt"
@@ -107,7 +282,10 @@ def save_as_nc(swath, layer_info, swath_path, save_name):
     year, abs_day, hour, minute = get_file_time_info(swath_path)
     #month = get_datetime(year, int(abs_day)).month
     minutes_since_2016 = minutes_since(int(year), int(abs_day), int(hour), int(minute))
-    fill_dataset(copy, variables, swath, layer_info, minutes_since_2016, abs_day, status)
+    fill_dataset(copy, variables, swath, layer_info, minutes_since_2016, abs_day, status, cloud_mask=cloud_mask)
+
+    if strip is not None:
+        add_strip(copy, variables, strip, compression=compression)
 
     copy.close()
 
@@ -116,11 +294,24 @@ if __name__ == "__main__":
     swath_path = sys.argv[2]
     save_dir = sys.argv[1]
 
-    swath, layer_info = load_npys(swath_path)
+    swath, layer_info, cloud_mask = load_npys(swath_path)
+
+    if layer_info is None:
+        sys.exit("no layer info saved for {}, extract the swath again to convert it".format(swath_path))
+
+    if "rows" in layer_info and "cols" in layer_info:
+
+        # only the pixels along the track are read from the memory-mapped swath
+        rows, cols = layer_info["rows"], layer_info["cols"]
+        swath, cloud_mask = gather_track(swath, rows, cols), None if cloud_mask is None else gather_track(cloud_mask, rows, cols)
+
+    else:
+        # layer infos saved as .npy hold only the occurrences, without the track indices the dataset variables are gathered at
+        sys.exit("no track indices in the layer info of {} (saved as .npy by an older version), extract the swath again to convert it".format(swath_path))
 
     # get time info
     year, abs_day, hour, minute = get_file_time_info(swath_path)
-    month = get_datetime(year, int(abs_day)).month
+    month = "{:02d}".format(get_datetime(int(year), int(abs_day)).month)
 
     # determine swath status from directory hierarchy
     status = "corrupt"
@@ -130,15 +321,15 @@ if __name__ == "__main__":
         status = "night"
 
     # create save directory
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    if not os.path.exists(os.path.join(save_dir, month, status)):
+        os.makedirs(os.path.join(save_dir, month, status))
 
     #create a copy of reference dataset
     copy_name = "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
-    copy, variables = copy_dataset_structure(os.path.join("netcdf", "cumulo.nc"), os.path.join(save_dir, month, status, copy_name))
+    copy, variables = copy_dataset_structure(os.path.join("netcdf", "datasetstr.nc"), os.path.join(save_dir, month, status, copy_name), swath)
 
     # convert npy to nc
     minutes_since_2016 = minutes_since(int(year), int(abs_day), int(hour), int(minute))
-    fill_dataset(copy, variables, swath, layer_info, minutes_since_2016, status)
+    fill_dataset(copy, variables, swath, layer_info["occurrences"], minutes_since_2016, abs_day, status, cloud_mask=cloud_mask)
 
     copy.close()
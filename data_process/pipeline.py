@@ -1,18 +1,351 @@
+import datetime
 import numpy as np
 import os
+import sys
 import time
 import traceback
 
 from PIL import Image
 from datetime import date
 
+import src.artifact_cache
 import src.cloudsat
 import src.interpolation
 import src.modis_level1
 import src.modis_level2
+import src.profiling
+import src.region
+import src.sampling
+import src.track_alignment
 
+from src.utils import RADIANCE_DTYPE, FLAG_DTYPE, FLAG_FILL_VALUE, get_datetime, get_file_time_info
 
-def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir, verbose=0, save=True):
+# version of the cached artifacts, to bump when the output of a stage changes so that the artifact cache is invalidated
+ARTIFACT_VERSION = 2
+
+# number of channels filled in a daylight swath, and in a night swath, whose visible channels are empty
+NB_DAYLIGHT_CHANNELS = 41
+NB_NIGHT_CHANNELS = 19
+
+def get_save_name(myd02_filename):
+    """ Returns the name of the NetCDF output of the granule, which also identifies it in the run ledger """
+
+    year, abs_day, hour, minute = get_file_time_info(myd02_filename)
+
+    return "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
+
+
+def get_input_dirs(myd02_filename, root_dir):
+    """
+    :param myd02_filename: MYD02 file, stored in a .../<month>/<day>/ directory
+    :param root_dir: root of the MODIS and CloudSat data tree
+    :return: the MYD03, MYD35, cloudsat-lidar and cloudsat directories of the granule, in the order of extract_swath_ontrack's arguments
+    """
+
+    month, day = os.path.dirname(myd02_filename).split("/")[-2:]
+    year, abs_day, hour, minute = get_file_time_info(myd02_filename)
+
+    #myd03 gec(lat,lon)
+    myd03_dir = os.path.join(root_dir, "MODIS", "MYD03", year, month, day)
+    #return a mask, with 0 for cloudy, 1 for uncertain/probably cloudy, 2 for probably clear, and 3 for clear.
+    myd35_dir = os.path.join(root_dir, "MODIS", "MYD35_L2",  year, month, day)
+    #label (cloud_occurrence) 0 -- non cloud determined or error, 1 -- cloud occurrences
+    cloudsat_lidar_dir = os.path.join(root_dir, "CloudSat", "2B-CLDCLASS-LIDAR", year, month)
+    cloudsat_dir = None
+
+    #cloudsat_dir = os.path.join(root_dir, "CloudSat")
+
+    return myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir
+
+
+def swath_intersects_track(myd02_filename, myd03_dir, cloudsat_lidar_dir, cloudsat_dir, margin=60, region=None):
+    """
+    Cheap pre-check, run before any radiance is read: whether a profile of the cloudsat track acquired during the swath falls inside the swath.
+    :param margin: seconds added on each side of the 5 minutes of the swath
+    :param region: optional region of interest (see src.region), only the profiles in the region are considered
+    Only the edges of the MYD03 geolocation and the decoded cloudsat granules (cached for the next swaths of the orbit) are read.
+    """
+
+    year, abs_day, hour, minute = get_file_time_info(os.path.basename(myd02_filename))
+    start = get_datetime(int(year), int(abs_day), int(hour), int(minute)) - datetime.timedelta(seconds=margin)
+    end = start + datetime.timedelta(seconds=src.modis_level1.SWATH_DURATION + 2 * margin)
+
+    cloudsat_filenames, get_quality = src.cloudsat.find_cloudsat_files(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+    cs_latitudes, cs_longitudes = src.cloudsat.get_track_in_window(cloudsat_filenames, start, end)
+
+    in_region = src.region.in_region(cs_latitudes, cs_longitudes, region)
+    cs_latitudes, cs_longitudes = cs_latitudes[in_region], cs_longitudes[in_region]
+
+    edge_latitudes, edge_longitudes = src.modis_level1.get_edge_geolocation(myd02_filename, myd03_dir)
+
+    return src.track_alignment.track_intersects_swath(cs_latitudes, cs_longitudes, edge_latitudes, edge_longitudes)
+
+
+def allocate_buffers(height=src.modis_level1.MAX_HEIGHT, width=src.modis_level1.MAX_WIDTH):
+    """
+    :return: the (41, height, width) float32 swath buffer and the (25, height, width) uint8 cloud mask buffer
+    The loaders write their channels straight into these buffers, which can be reused from one granule to the next.
+    """
+
+    swath_buffer = np.empty((src.modis_level1.NB_SWATH_CHANNELS, height, width), dtype=RADIANCE_DTYPE)
+    cm_buffer = np.empty((src.modis_level2.NB_MASK_CHANNELS, height, width), dtype=FLAG_DTYPE)
+
+    return swath_buffer, cm_buffer
+
+
+def group_by_orbit(myd02_filenames, root_dir):
+    """
+    :param myd02_filenames: MYD02 files to process
+    :param root_dir: root of the MODIS and CloudSat data tree
+    :return: dict mapping the (cloudsat filenames, get_quality) of each orbit, as returned by src.cloudsat.find_cloudsat_files, to its MYD02 files
+    Orbits are kept in the order of their first swath. Swaths without a matching cloudsat granule are grouped under None.
+    """
+
+    orbits = {}
+
+    for myd02_filename in myd02_filenames:
+
+        myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir = get_input_dirs(myd02_filename, root_dir)
+
+        try:
+            orbit = src.cloudsat.find_cloudsat_files(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+        except ValueError:
+            orbit = None
+
+        orbits.setdefault(orbit, []).append(myd02_filename)
+
+    return orbits
+
+
+def get_region_rows(scene, region):
+    """ Returns the range of rows of the swath scene holding pixels of the region, in whole scans; all rows if region is None """
+
+    if region is None:
+        return 0, src.modis_level1.MAX_HEIGHT
+
+    latitudes, longitudes = src.modis_level1.read_geolocation(scene)
+    start, stop = src.region.get_region_rows(latitudes, longitudes, region, scan_rows=src.modis_level1.SCAN_ROWS)
+
+    if start == stop:
+        raise ValueError("no pixel of the swath is in the region")
+
+    return start, stop
+
+
+def get_artifact_keys(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, region=None, fill_method="nearest"):
+    """
+    :return: dict of the keys of the cached artifacts of the granule (see src.artifact_cache), from the fingerprints of its input files and the parameters of each stage
+    Only the input files are looked up, none is read.
+    """
+
+    geoloc_fingerprint = src.artifact_cache.get_file_fingerprint(src.modis_level1.find_matching_geoloc_file(myd02_filename, myd03_dir))
+    cloud_mask_fingerprint = src.artifact_cache.get_file_fingerprint(src.modis_level2.find_cloud_mask_file(myd02_filename, myd35_dir))
+    cloudsat_filenames, get_quality = src.cloudsat.find_cloudsat_files(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+    params = {"version": ARTIFACT_VERSION, "region": region}
+
+    keys = {"rows": src.artifact_cache.make_key("rows", [geoloc_fingerprint], params),
+            "swath": src.artifact_cache.make_key("swath", [src.artifact_cache.get_file_fingerprint(myd02_filename), geoloc_fingerprint], params),
+            "cloud_mask": src.artifact_cache.make_key("cloud_mask", [cloud_mask_fingerprint, geoloc_fingerprint], params),
+            "cloudsat": src.artifact_cache.make_key("cloudsat", [src.artifact_cache.get_file_fingerprint(f) for f in cloudsat_filenames], {"version": ARTIFACT_VERSION, "get_quality": get_quality})}
+
+    # downstream artifacts are keyed by the artifacts they are computed from
+    keys["filled"] = src.artifact_cache.make_key("filled", [keys["swath"]], {"version": ARTIFACT_VERSION, "method": fill_method})
+    keys["alignment"] = src.artifact_cache.make_key("alignment", [keys["swath"], keys["cloudsat"]], {"version": ARTIFACT_VERSION})
+
+    return keys
+
+
+def load_granule_inputs(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, record=None, buffers=None, cloudsat_track=None, region=None, cache=None, fill_method="nearest"):
+    """
+    Reads all HDF inputs of a granule (MYD02, MYD03, MYD35 and CloudSat), with no computation, so that it can run ahead of the processing of the previous granule.
+    :param cloudsat_track: optional track of the granule's orbit, as returned by src.cloudsat.read_cloudsat_granules, read from the files otherwise
+    :param region: optional region of interest (see src.region): only the scans holding pixels of the region are read
+    :param cache: optional artifact cache (see src.artifact_cache): cached inputs are not read again, and the interpolated swath is returned if it is cached
+    :param fill_method: method of the interpolation of the swath, which keys its cached interpolated swath; the same as given to extract_swath_ontrack
+    :return: the swath (41, HEIGHT, WIDTH), the cloud mask (25, HEIGHT, WIDTH) and the cloudsat track (cs_latitudes, cs_longitudes, layer_info)
+    """
+
+    if buffers is None:
+        buffers = allocate_buffers()
+
+    swath_buffer, cm_buffer = buffers
+
+    keys = {} if cache is None else get_artifact_keys(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, region, fill_method)
+
+    # pull a numpy array from the hdfs
+    with src.profiling.stage(record, "l1b_load"):
+
+        scene = None
+        rows = src.artifact_cache.load_artifact(cache, keys.get("rows"))
+
+        if rows is None:
+            scene = src.modis_level1.load_swath_scene(myd02_filename, myd03_dir)
+            start, stop = get_region_rows(scene, region)
+
+            src.artifact_cache.save_artifact(cache, keys.get("rows"), {"rows": np.array([start, stop])})
+
+        else:
+            start, stop = (int(row) for row in rows["rows"])
+
+        filled = src.artifact_cache.load_artifact(cache, keys.get("filled"))
+        calibrated = None if filled is not None else src.artifact_cache.load_artifact(cache, keys.get("swath"))
+
+        if filled is not None:
+            # interpolated already: read-only, see extract_swath_ontrack
+            np_swath = filled["swath"]
+
+        elif calibrated is not None:
+            # copied, as it is interpolated in place
+            np_swath = swath_buffer[:, :calibrated["swath"].shape[1], :calibrated["swath"].shape[2]]
+            np_swath[...] = calibrated["swath"]
+
+        else:
+            if scene is None:
+                scene = src.modis_level1.load_swath_scene(myd02_filename, myd03_dir)
+
+            np_swath = src.modis_level1.read_swath(scene, out=swath_buffer, start=start, stop=stop)
+
+            src.artifact_cache.save_artifact(cache, keys.get("swath"), {"swath": np_swath})
+
+    # pull cloud mask channel
+    with src.profiling.stage(record, "cloud_mask_load"):
+
+        cached = src.artifact_cache.load_artifact(cache, keys.get("cloud_mask"))
+
+        if cached is not None:
+            cm = cached["cloud_mask"]
+
+        else:
+            cloud_mask, cloud_flag = src.modis_level2.open_cloud_mask(myd02_filename, myd35_dir)
+            cm = src.modis_level2.read_cloud_mask(cloud_mask, cloud_flag, out=cm_buffer, start=start, stop=stop)
+
+            src.artifact_cache.save_artifact(cache, keys.get("cloud_mask"), {"cloud_mask": cm})
+
+    if cloudsat_track is None:
+        with src.profiling.stage(record, "cloudsat_read"):
+
+            cached = src.artifact_cache.load_artifact(cache, keys.get("cloudsat"))
+
+            if cached is not None:
+                cloudsat_track = cached["latitudes"], cached["longitudes"], cached["layer_info"]
+
+            else:
+                cloudsat_track = src.cloudsat.read_cloudsat_track(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+                src.artifact_cache.save_artifact(cache, keys.get("cloudsat"), dict(zip(["latitudes", "longitudes", "layer_info"], cloudsat_track)))
+
+    return np_swath, cm, cloudsat_track
+
+
+def select_region_samples(geolocation, mapping, mapping_a, mapping_b, layer_info, region):
+    """
+    :param geolocation: the latitude and longitude channels of the swath, numpy.ndarray of size (2, HEIGHT, WIDTH)
+    :return mapping, mapping_a, mapping_b, layer_info: the co-located pixels (and their labels) that lie in the region
+    """
+
+    latitudes, longitudes = src.track_alignment.gather_track(geolocation, mapping_a, mapping_b)
+    in_region = src.region.in_region(latitudes, longitudes, region)
+
+    return np.asarray(mapping)[in_region], np.asarray(mapping_a)[in_region], np.asarray(mapping_b)[in_region], layer_info[in_region]
+
+
+def select_samples(mapping, mapping_a, mapping_b, layer_info, sampling, granule):
+    """
+    :param sampling: sampling policy (see src.sampling)
+    :return mapping, mapping_a, mapping_b, layer_info: the co-located pixels (and their labels) kept by the policy, in their order along the track
+    """
+
+    kept = src.sampling.get_sample_indices(layer_info, sampling, granule)
+
+    return np.asarray(mapping)[kept], np.asarray(mapping_a)[kept], np.asarray(mapping_b)[kept], layer_info[kept]
+
+
+def save_layer_info(layer_info_savepath, myd02_filename, cloudsat_lidar_dir, cloudsat_dir, layer_info, mapping, cs_range):
+    """ Saves the layer info of the co-located pixels as a .npz (see src.cloudsat.save_layer_info), with the acquisition time of their profiles """
+
+    profile_indices = np.asarray(mapping).reshape(-1, 3)[:, 2].astype(int)
+
+    if not os.path.exists(layer_info_savepath):
+        os.makedirs(layer_info_savepath)
+
+    try:
+        cloudsat_filenames, _ = src.cloudsat.find_cloudsat_files(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+        profile_times = src.cloudsat.get_track_times(cloudsat_filenames)[profile_indices]
+
+    except Exception as e:
+        # the layer info is still saved, with unknown (NaN) times
+        print("Couldn't get the profile times of {}: {}".format(os.path.basename(myd02_filename), e))
+        profile_times = None
+
+    src.cloudsat.save_layer_info(os.path.join(layer_info_savepath, os.path.basename(myd02_filename).replace(".hdf", ".npz")), layer_info, mapping, cs_range, profile_times)
+
+
+def new_track_strip(mapping_a, mapping_b, width, patch_size):
+    """
+    :param patch_size: size k of the k x k neighbourhoods kept around the co-located pixels
+    :return: dict of the float32 swath and uint8 cloud mask strips holding all neighbourhoods, filled with NaN and FLAG_FILL_VALUE outside of the
+    swath until copied with fill_track_strip, their swath "range", the "patch_size" and the strip "row_offsets" and "col_offsets" of each patch;
+    None if there is no co-located pixel. Overlapping neighbourhoods share the strip pixels, see src.track_alignment.get_patch_windows
+    """
+
+    if len(mapping_a) == 0:
+        return None
+
+    strip_range = src.track_alignment.get_strip_range(mapping_a, mapping_b, width, patch_size)
+    row_offsets, col_offsets = src.track_alignment.get_patch_offsets(mapping_a, mapping_b, width, strip_range, patch_size)
+
+    return {"swath": src.track_alignment.new_strip(src.modis_level1.NB_SWATH_CHANNELS, strip_range, RADIANCE_DTYPE, np.nan),
+            "cloud_mask": src.track_alignment.new_strip(src.modis_level2.NB_MASK_CHANNELS, strip_range, FLAG_DTYPE, FLAG_FILL_VALUE),
+            "range": strip_range, "patch_size": patch_size, "row_offsets": row_offsets, "col_offsets": col_offsets}
+
+
+def fill_track_strip(strip, np_swath, cm, first_row=0):
+    """ Copies the strip pixels of the swath and cloud mask, or of a block of them starting at row first_row """
+
+    if strip is not None:
+        src.track_alignment.copy_to_strip(strip["swath"], strip["range"], np_swath, first_row)
+        src.track_alignment.copy_to_strip(strip["cloud_mask"], strip["range"], cm, first_row)
+
+
+def make_save_dirs(save_dir):
+    """ Creates and returns the daylight, night and corrupt save directories """
+
+    # creating the save directories
+    save_dir_daylight = os.path.join(save_dir, "daylight")
+    save_dir_night = os.path.join(save_dir, "night")
+    #save_dir_test = os.path.join(save_dir, "test")
+    save_dir_corrupt = os.path.join(save_dir, "corrupt")
+
+    for dr in [save_dir_daylight, save_dir_night, save_dir_corrupt]:
+        if not os.path.exists(dr):
+            os.makedirs(dr)
+
+    return save_dir_daylight, save_dir_night, save_dir_corrupt
+
+
+def get_save_subdir(filled_ch_idx, save_dir_daylight, save_dir_night, save_dir_corrupt):
+    """ Classifies the swath from the indices of its channels that could be fully interpolated """
+
+    # if all channels were filled
+    if len(filled_ch_idx) == NB_DAYLIGHT_CHANNELS:
+        return save_dir_daylight
+
+    # if all but visible channels were filled
+    elif len(filled_ch_idx) == NB_NIGHT_CHANNELS:
+        return save_dir_night
+
+    return save_dir_corrupt
+
+
+def is_corrupt(fillable_ch_idx):
+    """ Whether a swath is corrupt whatever its interpolation, from the indices of the channels that can be filled (see src.interpolation.get_fillable_channels) """
+
+    return len(fillable_ch_idx) not in (NB_DAYLIGHT_CHANNELS, NB_NIGHT_CHANNELS)
+
+
+def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir, verbose=0, save=True, record=None, buffers=None, inputs=None, interpolation_workers=1, region=None, patch_size=None, cache=None, sampling=None, fill_method="nearest"):
     """
     :param myd02_filename: the filepath of the radiance (MYD02) input file
     :param myd03_dir: the root directory of geolocational (MYD03) files
@@ -21,94 +354,103 @@ def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_d
     :param cloudsat_dir: the root directory of cloudsat files
     :param save_dir:
     :param verbose: verbosity switch: 0 - silent, 1 - verbose, 2 - partial, only prints confirmation at end
-    :return: none
+    :param record: optional src.profiling record, filled with the duration of each stage
+    :param buffers: optional (swath buffer, cloud mask buffer) as returned by allocate_buffers, overwritten by this granule
+    :param inputs: optional inputs of the granule as returned by load_granule_inputs, e.g. prefetched; read from the files otherwise
+    :param interpolation_workers: number of threads filling the swath channels
+    :param region: optional region of interest (see src.region): only the scans and the samples in the region are processed and returned; prefetched inputs must have been loaded with the same region
+    :param patch_size: optional size k of the k x k neighbourhoods of the co-located pixels kept in a cross-track strip
+    :param cache: optional artifact cache (see src.artifact_cache): the inputs, the interpolated swath and the alignment are reused if their inputs did not change
+    :param sampling: optional sampling policy (see src.sampling): only the samples it keeps are gathered and returned
+    :param fill_method: method filling the invalid swath pixels, see src.interpolation.fill_all_channels
+    :return: the float32 swath channels (41, nb_pixels) and the uint8 cloud mask channels (25, nb_pixels) along the track, the layer info, the save directory, the swath name
+    and the strip of the neighbourhoods (see new_track_strip), None without patch_size
     Expects to find a corresponding MYD03 file in the same directory. Comments throughout
     """
 
     tail = os.path.basename(myd02_filename)
 
-    # creating the save directories
-    save_dir_daylight = os.path.join(save_dir, "daylight")
-    save_dir_night = os.path.join(save_dir, "night")
-    #save_dir_test = os.path.join(save_dir, "test")
-    save_dir_corrupt = os.path.join(save_dir, "corrupt")
+    save_dirs = make_save_dirs(save_dir)
 
-    for dr in [save_dir_daylight, save_dir_night, save_dir_corrupt]:
-        if not os.path.exists(dr):
-            os.makedirs(dr)
+    keys = {} if cache is None else get_artifact_keys(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, region, fill_method)
 
-    # pull a numpy array from the hdfs
-    np_swath = src.modis_level1.get_swath(myd02_filename, myd03_dir)
+    if inputs is None:
+        inputs = load_granule_inputs(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, record=record, buffers=buffers, region=region, cache=cache, fill_method=fill_method)
+
+    np_swath, cm, cloudsat_track = inputs
 
     if verbose:
-        print("swath {} loaded".format(tail))
+        print("swath {} and cloud mask loaded".format(tail))
 
     # as some bands have artefacts, we need to interpolate the missing data - time intensive
-    t1 = time.time()
-    
-    filled_ch_idx = src.interpolation.fill_all_channels(np_swath)  
-    
-    t2 = time.time()
+    with src.profiling.stage(record, "interpolation"):
 
-    if verbose:
-        print("Interpolation took {} s".format(t2-t1))
-        print("Channels", filled_ch_idx, "are now full")
-        print("length of channels",len(filled_ch_idx))
+        filled = src.artifact_cache.load_artifact(cache, keys.get("filled"))
 
-    # if all channels were filled
-    if len(filled_ch_idx) == 41:
-        save_subdir = save_dir_daylight
+        if filled is not None:
+            np_swath, filled_ch_idx = filled["swath"], list(filled["filled_channels"])
 
-    # if all but visible channels were filled
-    elif len(filled_ch_idx) == 19:
-        save_subdir = save_dir_night
+        else:
+            fillable_ch_idx = src.interpolation.get_fillable_channels(np_swath)
 
-    else:
-        save_subdir = save_dir_corrupt
+            # the interpolation can only lose channels: a swath that is corrupt before it is not interpolated
+            if is_corrupt(fillable_ch_idx):
+                filled_ch_idx = fillable_ch_idx
+            else:
+                filled_ch_idx = src.interpolation.fill_all_channels(np_swath, method=fill_method, n_workers=interpolation_workers, channels=fillable_ch_idx)
 
-    # pull cloud mask channel
-    cm = src.modis_level2.get_cloud_mask(myd02_filename, myd35_dir)
+            src.artifact_cache.save_artifact(cache, keys.get("filled"), {"swath": np_swath, "filled_channels": np.array(filled_ch_idx, dtype=int)})
 
     if verbose:
-        print("Cloud mask loaded")
+        print("Interpolation took {} s".format(src.profiling.get_duration(record, "interpolation")))
+        print("Channels", filled_ch_idx, "are now full")
+        print("length of channels",len(filled_ch_idx))
 
-    # get cloudsat alignment - time intensive
-    t1 = time.time()
+    save_subdir = get_save_subdir(filled_ch_idx, *save_dirs)
 
+    # get cloudsat alignment - time intensive
     try:
         # alignment returns:
         # cs_range: minimal and maximal column indices of the satellite track for the current swath 
         # mapping: cloudsat-pixels -> swath pixels
         # laye_info: available cloudsat variable values for the current swath
-        cs_range, mapping, mapping_a, mapping_b, layer_info = src.cloudsat.get_cloudsat_mask(myd02_filename, cloudsat_lidar_dir, cloudsat_dir, np_swath[-2], np_swath[-1], map_label=False)
+        alignment = src.artifact_cache.load_artifact(cache, keys.get("alignment"))
+
+        if alignment is not None:
+            cs_range, mapping, mapping_a, mapping_b, layer_info = tuple(alignment["cs_range"]), alignment["mapping"], alignment["mapping_a"], alignment["mapping_b"], alignment["layer_info"]
+
+        else:
+            cs_range, mapping, mapping_a, mapping_b, layer_info = src.cloudsat.get_cloudsat_mask(myd02_filename, cloudsat_lidar_dir, cloudsat_dir, np_swath[-2], np_swath[-1], map_label=False, record=record, track=cloudsat_track)
+
+            src.artifact_cache.save_artifact(cache, keys.get("alignment"), {"cs_range": np.array(cs_range), "mapping": mapping, "mapping_a": mapping_a, "mapping_b": mapping_b, "layer_info": layer_info})
 
     except Exception as e:
         print("Couldn't extract cloudsat track of {}: {}".format(tail, e))
         traceback.print_exc(file=sys.stdout)
-    else:
-        print("Nothing went wrong")
 
-    t2 = time.time()
+        # nothing can be gathered without the track: the granule is recorded as failed with the actual error
+        raise
 
     if verbose:
-        print("Cloudsat alignment took {} s".format(t2 - t1))
+        print("Cloudsat alignment took {} s".format(src.profiling.get_duration(record, "cloudsat_read") + src.profiling.get_duration(record, "alignment")))
 
-    # cast swath values in the range of the satellite track, cast swath values to float
-    np_swath = np.vstack([np_swath, cm]).astype(np.float32)
-    print(np_swath.shape, np_swath[0].shape, np_swath[0].shape[1])
-    
-    index = [np_swath[0].shape[1] - i for i in mapping_b]
-    np_swath_final = np.zeros((66, mapping.shape[0]))
-    print(np_swath_final.shape, np_swath_final[0].shape)
-    
-    for cl in range (np_swath.shape[0]):
-        temp = np_swath[cl]
-        c = 0
-        for i in mapping_a:
-            reshape_v = temp[i]
-            #print(reshape_v.shape)
-            np_swath_final[cl][c] = reshape_v[index[c]]
-            c = c+1
+    with src.profiling.stage(record, "gather"):
+
+        if region is not None:
+            mapping, mapping_a, mapping_b, layer_info = select_region_samples(np_swath[-2:], mapping, mapping_a, mapping_b, layer_info, region)
+
+        if sampling is not None:
+            mapping, mapping_a, mapping_b, layer_info = select_samples(mapping, mapping_a, mapping_b, layer_info, sampling, tail)
+
+        # swath values in the range of the satellite track: radiances and flags are kept in their own dtypes
+        np_swath_final = src.track_alignment.gather_track(np_swath, mapping_a, mapping_b)
+        cm_final = src.track_alignment.gather_track(cm, mapping_a, mapping_b)
+
+        strip = None
+
+        if patch_size:
+            strip = new_track_strip(mapping_a, mapping_b, np_swath.shape[2], patch_size)
+            fill_track_strip(strip, np_swath, cm)
 
     # create the save path for the swath array, and save the array as a npy, with the same name as the input file.
     swath_savepath_str = os.path.join(save_subdir, tail.replace(".hdf", ".npy"))
@@ -119,6 +461,13 @@ def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_d
     if save:
         np.save(swath_savepath_str, np_swath, allow_pickle=False)
 
+        cloud_mask_savepath = os.path.join(save_subdir, "cloud-mask")
+
+        if not os.path.exists(cloud_mask_savepath):
+            os.makedirs(cloud_mask_savepath)
+
+        np.save(os.path.join(cloud_mask_savepath, tail.replace(".hdf", ".npy")), cm, allow_pickle=False)
+
         if verbose:
             print("swath saved as {}".format(swath_savepath_str))
     
@@ -129,11 +478,8 @@ def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_d
         if save:
 
             layer_info_savepath = os.path.join(save_subdir, "layer-info")
-    
-            if not os.path.exists(layer_info_savepath):
-                os.makedirs(layer_info_savepath)
-            
-            np.save(os.path.join(layer_info_savepath, tail.replace(".hdf", ".npy")), layer_info)
+
+            save_layer_info(layer_info_savepath, myd02_filename, cloudsat_lidar_dir, cloudsat_dir, layer_info, mapping, cs_range)
             if verbose:
                 print("layer-info saved as {}".format(layer_info_savepath))
 
@@ -141,61 +487,466 @@ def extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_d
         
         layer_info = None
 
-    return np_swath_final, layer_info, save_subdir, tail
+    return np_swath_final, cm_final, layer_info, save_subdir, tail, strip
+
+
+def extract_swath_ontrack_by_blocks(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir, block_rows=200, halo=src.modis_level1.SCAN_ROWS, verbose=0, save=True, record=None, interpolation_workers=1, cloudsat_track=None, region=None, patch_size=None, sampling=None, fill_method="nearest"):
+    """
+    Out-of-core version of extract_swath_ontrack, with the same arguments and return values: the swath is read, interpolated,
+    decoded and gathered in along-track blocks of whole MODIS scans, so that the peak memory depends on block_rows rather than on the granule size.
+    :param block_rows: number of swath rows per block, rounded down to a multiple of the 10 rows of a scan
+    :param halo: number of rows read on each side of a block so that the interpolation of its edges sees the neighbouring scans
+    :param cloudsat_track: optional track of the granule's orbit, read from the files otherwise
+    :param region: optional region of interest (see src.region): only the scans and the samples in the region are processed and returned
+    :param patch_size: optional size k of the k x k neighbourhoods of the co-located pixels kept in a cross-track strip
+    :param sampling: optional sampling policy (see src.sampling): only the samples it keeps are gathered and returned
+    Only the geolocation (2 channels) and the samples along the track are held for the whole granule. With save, the
+    swath and cloud mask npys are written block by block through memory maps.
+    """
+
+    tail = os.path.basename(myd02_filename)
+
+    save_dirs = make_save_dirs(save_dir)
+
+    # the scenes are opened lazily: only the rows of a block are read from the files
+    with src.profiling.stage(record, "l1b_load"):
+        scene = src.modis_level1.load_swath_scene(myd02_filename, myd03_dir)
+        latitudes, longitudes = src.modis_level1.read_geolocation(scene)
+
+    # rows of the region, in whole scans: the block rows below are relative to first_row
+    first_row, last_row = 0, latitudes.shape[0]
+
+    if region is not None:
+        first_row, last_row = src.region.get_region_rows(latitudes, longitudes, region, scan_rows=src.modis_level1.SCAN_ROWS)
+
+        if first_row == last_row:
+            raise ValueError("no pixel of the swath is in the region")
+
+        latitudes, longitudes = latitudes[first_row:last_row], longitudes[first_row:last_row]
+
+    with src.profiling.stage(record, "cloud_mask_load"):
+        cloud_mask, cloud_flag = src.modis_level2.open_cloud_mask(myd02_filename, myd35_dir)
+
+    if cloudsat_track is None:
+        with src.profiling.stage(record, "cloudsat_read"):
+            cloudsat_track = src.cloudsat.read_cloudsat_track(myd02_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+    if verbose:
+        print("swath {} and cloud mask opened".format(tail))
+
+    # the alignment only needs the geolocation
+    try:
+        cs_range, mapping, mapping_a, mapping_b, layer_info = src.cloudsat.get_cloudsat_mask(myd02_filename, cloudsat_lidar_dir, cloudsat_dir, latitudes, longitudes, map_label=False, record=record, track=cloudsat_track)
+
+    except Exception as e:
+        print("Couldn't extract cloudsat track of {}: {}".format(tail, e))
+        traceback.print_exc(file=sys.stdout)
+
+        # nothing can be gathered without the track: the granule is recorded as failed with the actual error
+        raise
+
+    height, width = latitudes.shape
+    mapping_a, mapping_b = np.asarray(mapping_a), np.asarray(mapping_b)
+
+    if region is not None:
+        mapping, mapping_a, mapping_b, layer_info = select_region_samples(np.stack([latitudes, longitudes]), mapping, mapping_a, mapping_b, layer_info, region)
+
+    if sampling is not None:
+        mapping, mapping_a, mapping_b, layer_info = select_samples(mapping, mapping_a, mapping_b, layer_info, sampling, tail)
+
+    strip = new_track_strip(mapping_a, mapping_b, width, patch_size) if patch_size else None
+
+    np_swath_final = np.empty((src.modis_level1.NB_SWATH_CHANNELS, mapping_a.shape[0]), dtype=RADIANCE_DTYPE)
+    cm_final = np.empty((src.modis_level2.NB_MASK_CHANNELS, mapping_a.shape[0]), dtype=FLAG_DTYPE)
+
+    # a channel is full if it could be filled in every block
+    filled = np.ones(src.modis_level1.NB_SWATH_CHANNELS, dtype=bool)
+
+    blocks = list(src.modis_level1.scan_blocks(height, block_rows, halo))
+    swath_buffer, cm_buffer = allocate_buffers(max(halo_stop - halo_start for _, _, halo_start, halo_stop in blocks), width)
+
+    if save:
+        # written next to the outputs, and moved to the daylight/night/corrupt directory once the swath is classified
+        swath_tmp_path = os.path.join(save_dir, tail.replace(".hdf", ".swath.npy"))
+        cm_tmp_path = os.path.join(save_dir, tail.replace(".hdf", ".cloud-mask.npy"))
+
+        swath_memmap = np.lib.format.open_memmap(swath_tmp_path, mode='w+', dtype=RADIANCE_DTYPE, shape=(src.modis_level1.NB_SWATH_CHANNELS, height, width))
+        cm_memmap = np.lib.format.open_memmap(cm_tmp_path, mode='w+', dtype=FLAG_DTYPE, shape=(src.modis_level2.NB_MASK_CHANNELS, height, width))
+
+    for start, stop, halo_start, halo_stop in blocks:
+
+        with src.profiling.stage(record, "l1b_load"):
+            block = src.modis_level1.read_swath(scene, out=swath_buffer, start=first_row + halo_start, stop=first_row + halo_stop)
+
+        with src.profiling.stage(record, "interpolation"):
+
+            # channels that are not full in a previous block are not full in the swath, and a swath that is already corrupt is not interpolated
+            fillable_block = [i for i in src.interpolation.get_fillable_channels(block) if filled[i]]
+            filled[np.setdiff1d(np.arange(filled.shape[0]), fillable_block)] = False
+
+            if not is_corrupt(np.flatnonzero(filled)):
+                filled_block = src.interpolation.fill_all_channels(block, method=fill_method, n_workers=interpolation_workers, channels=fillable_block)
+                filled[np.setdiff1d(np.arange(filled.shape[0]), filled_block)] = False
+
+        # the halo rows are dropped once the block is interpolated
+        block = block[:, start - halo_start:stop - halo_start]
+
+        with src.profiling.stage(record, "cloud_mask_load"):
+            cm_block = src.modis_level2.read_cloud_mask(cloud_mask, cloud_flag, out=cm_buffer, start=first_row + start, stop=first_row + stop)
+
+        with src.profiling.stage(record, "gather"):
+            in_block = (mapping_a >= start) & (mapping_a < stop)
+
+            np_swath_final[:, in_block] = src.track_alignment.gather_track(block, mapping_a[in_block] - start, mapping_b[in_block])
+            cm_final[:, in_block] = src.track_alignment.gather_track(cm_block, mapping_a[in_block] - start, mapping_b[in_block])
+
+            fill_track_strip(strip, block, cm_block, first_row=start)
+
+        if save:
+            swath_memmap[:, start:stop] = block
+            cm_memmap[:, start:stop] = cm_block
+
+    filled_ch_idx = list(np.flatnonzero(filled))
+
+    if verbose:
+        print("Interpolation took {} s".format(src.profiling.get_duration(record, "interpolation")))
+        print("Channels", filled_ch_idx, "are now full")
+        print("length of channels",len(filled_ch_idx))
+
+    save_subdir = get_save_subdir(filled_ch_idx, *save_dirs)
+
+    if save:
+        swath_memmap.flush()
+        cm_memmap.flush()
+        del swath_memmap, cm_memmap
+
+        cloud_mask_savepath = os.path.join(save_subdir, "cloud-mask")
+
+        if not os.path.exists(cloud_mask_savepath):
+            os.makedirs(cloud_mask_savepath)
+
+        os.replace(swath_tmp_path, os.path.join(save_subdir, tail.replace(".hdf", ".npy")))
+        os.replace(cm_tmp_path, os.path.join(cloud_mask_savepath, tail.replace(".hdf", ".npy")))
+
+        save_layer_info(os.path.join(save_subdir, "layer-info"), myd02_filename, cloudsat_lidar_dir, cloudsat_dir, layer_info, mapping, cs_range)
+
+        if verbose:
+            print("swath saved in {}".format(save_subdir))
+
+    return np_swath_final, cm_final, layer_info, save_subdir, tail, strip
 
 
 
 # Hook for bash
 if __name__ == "__main__":
 
-    import sys
+    import queue
+    import socket
+    import threading
 
-    from pathlib import Path
-    
     from netcdf.npy_to_nc import save_as_nc
-    from src.utils import get_file_time_info
+    from src import granule_cache
+    from src.channel_stats import update_status_stats, save_stats
+    from src.ledger import LEDGER_NAME, DONE, FAILED, SKIPPED, open_ledger, import_outputs, add_granules, get_granules, reset_stale, claim_granule, get_state, mark_done, mark_failed, mark_skipped
+    from src.prefetch import prefetch
+    from src.profiling import new_record, stage, write_record
+    from src.writer import start_writers, submit, get_results, stop_writers
     
-    #get the myd02 file directory (Channel 1-36, Swath pixel)
-    myd02_filename = sys.argv[1]
     #save_dir = sys.argv[2]
     save_dir = '/Users/documents/Desk/Antarctic_sea_ice/Dataset_test/'
-    
-    root_dir, filename = os.path.split(myd02_filename)
+    root_dir2 = "/Users/documents/Desk/Antarctic_sea_ice/Dataset_test/"
 
-    month, day = root_dir.split("/")[-2:]
+    # one JSON line of stage timings per granule; stages listed in profile_stages (e.g. "interpolation") are also run under cProfile
+    timings_path = os.path.join(save_dir, "timings.jsonl")
+    profile_stages = []
 
-    # get time info
-    year, abs_day, hour, minute = get_file_time_info(myd02_filename)
-    save_name = "A{}.{}.{}{}.nc".format(year, abs_day, hour, minute)
+    # number of granules whose inputs are read ahead on a background thread while the current one is processed (0 to disable)
+    prefetch_depth = 1
 
-    # recursvely check if file exist in save_dir
-    for _ in Path(save_dir).rglob(save_name):
-        raise FileExistsError("{} already exist. Not extracting it again.".format(save_name))
-    
-    root_dir2 = "/Users/documents/Desk/Antarctic_sea_ice/Dataset_test/"
-    
-    #myd03 gec(lat,lon)
-    myd03_dir = os.path.join(root_dir2, "MODIS", "MYD03", year, month, day)
-    #return a mask, with 0 for cloudy, 1 for uncertain/probably cloudy, 2 for probably clear, and 3 for clear.
-    myd35_dir = os.path.join(root_dir2, "MODIS", "MYD35_L2",  year, month, day)
-    cloudsat_dir = None
-    #label (cloud_occurrence) 0 -- non cloud determined or error, 1 -- cloud occurrences
-    cloudsat_lidar_dir = os.path.join(root_dir2, "CloudSat", "2B-CLDCLASS-LIDAR", year, month)
+    # number of threads interpolating the channels of a granule, e.g. os.cpu_count() to reprocess a short time range urgently
+    interpolation_workers = 1
 
-    #cloudsat_dir = os.path.join(root_dir, "CloudSat")
+    # number of swath rows processed at once, to bound the memory of a worker on small nodes (e.g. 200); None processes whole granules
+    block_rows = None
 
-    # extract training channels, validation channels, cloud mask, class occurences if provided
-    np_swath, layer_info, save_subdir, swath_name = extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_dir, cloudsat_lidar_dir, save_dir=save_dir, verbose=2, save=False)
-    #np_swath: np-array co-located swath for (myd02,myd03,myd35)
-    
-  
-    #save swath as netcdf
-    test_name = os.path.join(save_subdir, save_name)
-    save_as_nc(np_swath, layer_info, swath_name, test_name)
+    # process the swaths orbit by orbit, reading each cloudsat granule once for the ~20 swaths it overlaps
+    orbit_mode = True
+
+    # memory bound of the in-process cache of decoded cloudsat granules (~1 MB each), 0 to disable it
+    granule_cache.set_max_bytes(granule_cache.DEFAULT_MAX_BYTES)
+
+    # skip the swaths that the cloudsat track does not cross, checked on the swath outline before reading any radiance
+    prefilter = True
+
+    # region of interest (see src.region), e.g. {"max_latitude": -60.} for the south of 60°S: only its scans are read and interpolated,
+    # and only its samples are written; None for the whole swath
+    region = None
+
+    # size k of the k x k neighbourhoods of the co-located pixels written along with them (e.g. 3 or 5, for CNNs); None to write the pixels only
+    patch_size = None
+
+    # subsampling of the co-located pixels before they are gathered and written (see src.sampling), e.g. {"ratio": 1., "seed": 0} for
+    # balanced cloudy and clear samples, or {"max_samples": 5000}; None writes all of them
+    sampling = None
+
+    # filling of the invalid swath pixels: "stripes" interpolates the rows of dead detectors from the neighbouring detectors of their
+    # scan, much faster than the 2d "nearest" interpolation it falls back to for the other gaps
+    fill_method = "stripes"
+
+    # directory of the artifact cache of the intermediate stages, reused when only some inputs of a granule are reprocessed; None to disable it.
+    # Not used in block mode, which does not hold whole granules
+    artifact_cache_dir = None
+    artifact_cache_bytes = 200 * 2**30
+
+    # compression of the netcdf outputs, a preset of netcdf.npy_to_nc.COMPRESSION_PRESETS ("quantized" rounds the radiances below their
+    # noise for ~2-4x smaller files; compare the presets on a few outputs with python -m benchmarks.nc_compression)
+    nc_compression = "zlib"
+
+    # number of processes compressing and writing the netcdf outputs in the background, while the next granules are processed;
+    # 0 writes each output inline. At most writer_depth finished outputs wait for a writer, the extraction blocks beyond
+    nb_writers = 0
+    writer_depth = 2
+
+    # granules left running for longer than this (in seconds) were interrupted, by a killed or crashed run, and are extracted again.
+    # It must exceed the time a granule can take, including its wait for a writer, as other workers may still be running theirs
+    stale_after = 6 * 3600
+
+    # per-channel statistics of the extracted samples by swath status, for the normalization of the features, saved by each run as
+    # <channel_stats_dir>/<host>-<pid>.npz; merge them with python -m src.channel_stats <prefix> <files>. None not to compute them
+    channel_stats_dir = os.path.join(save_dir, "channel-stats")
+    channel_stats = {}
+
+    artifact_cache = None if artifact_cache_dir is None else src.artifact_cache.open_cache(artifact_cache_dir, artifact_cache_bytes)
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    # the ledger records the state of every granule, so that interrupted runs can be resumed without walking save_dir
+    ledger_path = os.path.join(save_dir, LEDGER_NAME)
+    new_ledger = not os.path.exists(ledger_path)
+
+    ledger = open_ledger(ledger_path)
+
+    if new_ledger:
+        import_outputs(ledger, save_dir)
+
+    nb_stale = reset_stale(ledger, stale_after)
+
+    if nb_stale:
+        print("{} granules interrupted by a previous run will be extracted again".format(nb_stale))
+
+    add_granules(ledger, [get_save_name(myd02_filename) for myd02_filename in sys.argv[1:]])
+
+    # swath buffers shared by all granules of the run: one set for the granule being processed, and one per prefetched granule
+    buffer_pool = queue.Queue()
+    for _ in range(0 if block_rows else prefetch_depth + 1):
+        buffer_pool.put(allocate_buffers())
+
+    #get the myd02 file directories (Channel 1-36, Swath pixel), one or several granules
+    myd02_filenames = []
+
+    for myd02_filename in sys.argv[1:]:
+
+        save_name = get_save_name(myd02_filename)
+        state = get_state(ledger, save_name)
+
+        # granules running in another worker are left to claim_granule, which only refuses them while they are not stale
+        if state in (DONE, SKIPPED):
+            print("{} already {}. Not extracting it again.".format(save_name, state))
+            continue
+
+        if prefilter:
+            myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir = get_input_dirs(myd02_filename, root_dir2)
+
+            try:
+                intersects = swath_intersects_track(myd02_filename, myd03_dir, cloudsat_lidar_dir, cloudsat_dir, region=region)
+
+            except Exception as e:
+                # missing inputs are reported when the granule is processed
+                print("Couldn't pre-check {}: {}".format(save_name, e))
+                intersects = True
+
+            if not intersects:
+                mark_skipped(ledger, save_name, "cloudsat track does not cross the swath in the region")
+                print("{} skipped: the cloudsat track does not cross the swath in the region".format(save_name))
+                continue
+
+        myd02_filenames.append(myd02_filename)
+
+    # the cloudsat files of each swath's orbit, None if the track of the swath is read on its own
+    orbit_of = dict.fromkeys(myd02_filenames)
+
+    if orbit_mode:
+        orbits = group_by_orbit(myd02_filenames, root_dir2)
+        myd02_filenames = [myd02_filename for orbit_filenames in orbits.values() for myd02_filename in orbit_filenames]
+
+        for orbit, orbit_filenames in orbits.items():
+            orbit_of.update(dict.fromkeys(orbit_filenames, orbit))
+
+        print("{} swaths over {} orbits".format(len(myd02_filenames), len(orbits)))
+
+    # the track of the orbit being loaded, kept until the first swath of the next orbit; only used by the loading thread
+    orbit_tracks = {}
+
+    def load_track(myd02_filename, record):
+
+        orbit = orbit_of[myd02_filename]
+
+        if orbit is None:
+            return None
+
+        if orbit not in orbit_tracks:
+            orbit_tracks.clear()
+
+            with stage(record, "cloudsat_read"):
+                orbit_tracks[orbit] = src.cloudsat.read_cloudsat_granules(*orbit)
+
+        return orbit_tracks[orbit]
+
+    # the granules are claimed by the thread loading them, with its own connection as sqlite connections are bound to their thread
+    loading_ledgers = threading.local()
+
+    def load(myd02_filename):
+
+        save_name = get_save_name(myd02_filename)
+
+        if not hasattr(loading_ledgers, "connection"):
+            loading_ledgers.connection = open_ledger(ledger_path)
+
+        # claimed before any input is read, so that workers given overlapping granules do not both load them; a granule whose
+        # inputs then fail to load is marked as failed by the processing loop
+        if not claim_granule(loading_ledgers.connection, save_name, myd02_filename):
+            return None
+
+        record = new_record(save_name, profile_stages, profile_dir=save_dir)
+        cloudsat_track = load_track(myd02_filename, record)
+
+        if block_rows:
+            # the blocks of the swath are read while it is processed
+            return record, None, (None, None, cloudsat_track)
+
+        # blocks until the granule processed before the previous one releases its buffers
+        buffers = buffer_pool.get()
+
+        try:
+            inputs = load_granule_inputs(myd02_filename, *get_input_dirs(myd02_filename, root_dir2), record=record, buffers=buffers, cloudsat_track=cloudsat_track, region=region, cache=artifact_cache, fill_method=fill_method)
+
+        except:
+            buffer_pool.put(buffers)
+            raise
+
+        return record, buffers, inputs
+
+    writers = start_writers(save_as_nc, nb_writers, writer_depth) if nb_writers > 0 else None
+
+    # the granules handed to the writers, by name: (netcdf path, record, save subdirectory, number of samples)
+    writing = {}
+
+    def finish_granule(save_name, test_name, record, save_subdir, nb_samples):
+
+        mark_done(ledger, save_name, test_name)
+        write_record(timings_path, record, status=os.path.basename(save_subdir), nb_samples=nb_samples)
+
+        if "corrupt" in save_subdir:
+            print("Failed to extract tiles: tiles are extracted only from swaths with fully interpolated non-visible channels")
+
+    def finish_writes(wait=False):
+
+        for save_name, seconds, error in get_results(writers, wait=wait):
+
+            test_name, record, save_subdir, nb_samples = writing.pop(save_name)
+            record["stages"]["nc_write"] = seconds
+
+            if error is not None:
+                mark_failed(ledger, save_name, error)
+                write_record(timings_path, record, status="failed")
+                print("Failed to write {}: {}".format(save_name, error))
+                continue
+
+            finish_granule(save_name, test_name, record, save_subdir, nb_samples)
+
+    for myd02_filename, loaded, error in prefetch(myd02_filenames, load, prefetch_depth):
+
+        if writers is not None:
+            finish_writes()
+
+        save_name = get_save_name(myd02_filename)
+
+        if error is not None:
+            mark_failed(ledger, save_name, error)
+            print("Failed to read {}: {}".format(save_name, error))
+            continue
+
+        if loaded is None:
+            print("{} already {}. Not extracting it again.".format(save_name, get_state(ledger, save_name)))
+            continue
+
+        record, buffers, inputs = loaded
+        myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir = get_input_dirs(myd02_filename, root_dir2)
+
+        try:
+            # extract training channels, validation channels, cloud mask, class occurences if provided
+            if block_rows:
+                np_swath, cloud_mask, layer_info, save_subdir, swath_name, strip = extract_swath_ontrack_by_blocks(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir=save_dir, block_rows=block_rows, verbose=2, save=False, record=record, interpolation_workers=interpolation_workers, cloudsat_track=inputs[2], region=region, patch_size=patch_size, sampling=sampling, fill_method=fill_method)
+            else:
+                np_swath, cloud_mask, layer_info, save_subdir, swath_name, strip = extract_swath_ontrack(myd02_filename, myd03_dir, myd35_dir, cloudsat_lidar_dir, cloudsat_dir, save_dir=save_dir, verbose=2, save=False, record=record, inputs=inputs, interpolation_workers=interpolation_workers, region=region, patch_size=patch_size, cache=artifact_cache, sampling=sampling, fill_method=fill_method)
+            #np_swath: np-array co-located swath for (myd02,myd03,myd35)
+
+            # a track without samples (e.g. none in the region) would be written as a file with one fake sample
+            if np_swath.shape[1] == 0:
+                mark_skipped(ledger, save_name, "no co-located sample kept")
+                write_record(timings_path, record, status="skipped", nb_samples=0)
+                print("{} skipped: no co-located sample kept".format(save_name))
+                continue
     
-    if "corrupt" in save_subdir:
-        print("Failed to extract tiles: tiles are extracted only from swaths with fully interpolated non-visible channels")
-        exit(0)
+            #save swath as netcdf
+            test_name = os.path.join(save_subdir, save_name)
+
+            if channel_stats_dir is not None:
+                with stage(record, "channel_stats"):
+                    update_status_stats(channel_stats, os.path.basename(save_subdir), np_swath)
+
+            if writers is not None:
+                # blocks while the writers are behind
+                with stage(record, "nc_submit"):
+                    submit(writers, save_name, np_swath, layer_info, swath_name, test_name, cloud_mask=cloud_mask, strip=strip, compression=nc_compression)
+
+                writing[save_name] = (test_name, record, save_subdir, np_swath.shape[1])
+
+            else:
+                with stage(record, "nc_write"):
+                    save_as_nc(np_swath, layer_info, swath_name, test_name, cloud_mask=cloud_mask, strip=strip, compression=nc_compression)
+
+        except Exception as e:
+            mark_failed(ledger, save_name, e)
+            write_record(timings_path, record, status="failed")
+            print("Failed to extract {}: {}".format(save_name, e))
+            continue
+
+        finally:
+            if buffers is not None:
+                buffer_pool.put(buffers)
+
+        if writers is None:
+            finish_granule(save_name, test_name, record, save_subdir, np_swath.shape[1])
+
+    if writers is not None:
+        finish_writes(wait=True)
+        stop_writers(writers)
+
+    if channel_stats_dir is not None and channel_stats:
+
+        if not os.path.exists(channel_stats_dir):
+            os.makedirs(channel_stats_dir)
+
+        save_stats(os.path.join(channel_stats_dir, "{}-{}.npz".format(socket.gethostname(), os.getpid())), channel_stats)
+
+    print("cloudsat granule cache:", granule_cache.get_stats())
+
+    failed = get_granules(ledger, FAILED)
+
+    if failed:
+        print("{} granules failed so far, see the error column of {}: {}".format(len(failed), ledger_path, ", ".join(failed)))
 
     # # save visible channels as png for visualization purposes
-    # extract_swath_rbg(myd02_filename, os.path.join(year, month, day), save_subdir, verbose=1)
\ No newline at end of file
+    # extract_swath_rbg(myd02_filename, os.path.join(year, month, day), save_subdir, verbose=1)
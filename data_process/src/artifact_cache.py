@@ -0,0 +1,157 @@
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import time
+import uuid
+
+'''On-disk cache of the intermediate artifacts of the pipeline stages (calibrated swath, filled swath, decoded cloud mask,
+cloudsat track, alignment). An artifact is a set of named arrays stored as .npy files in a directory named after its key:
+a hash of the stage, of the fingerprints of the input files and upstream artifact keys, and of the stage parameters.
+Changing an input or a parameter changes the key, so that only the invalidated stages rerun. The least recently used
+artifacts are evicted once the cache exceeds its size. Several workers can share a cache directory.'''
+
+# names of the arrays of an artifact, written with them: an artifact missing any of them is being evicted
+MANIFEST_NAME = "manifest.json"
+
+# seconds after which a save scans the cache again, to count the artifacts stored by the other workers
+SCAN_INTERVAL = 600
+
+def open_cache(cache_dir, max_bytes):
+    """
+    :param cache_dir: directory of the cache, created if it does not exist
+    :param max_bytes: size above which the least recently used artifacts are evicted
+    :return: cache dict, passed to the other functions
+    """
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # the size of the cache is tracked from the last scan, so that saves only scan it when it may exceed max_bytes
+    return {"dir": cache_dir, "max_bytes": max_bytes, "bytes": None, "scanned": 0.}
+
+def get_file_fingerprint(path):
+    """ Returns the identity of an input file: its absolute path, size and modification time, which change when it is reprocessed """
+
+    stat = os.stat(path)
+
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def make_key(stage, inputs, params=None):
+    """
+    :param stage: name of the stage producing the artifact
+    :param inputs: JSON-serializable fingerprints of the input files and keys of the upstream artifacts
+    :param params: JSON-serializable parameters of the stage, including a version to bump when its code changes
+    :return: key of the artifact, "<stage>-<hash>"
+    """
+
+    description = json.dumps([stage, inputs, params], sort_keys=True, default=str)
+
+    return "{}-{}".format(stage, hashlib.sha256(description.encode()).hexdigest()[:32])
+
+def load_artifact(cache, key):
+    """ Returns the arrays of the artifact as a dict of read-only memory maps, or None if it is not cached (or if cache is None) """
+
+    if cache is None:
+        return None
+
+    path = os.path.join(cache["dir"], key)
+
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            names = json.load(f)
+
+        # an array removed by an eviction meanwhile fails the whole load, rather than being left out of the artifact
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r', allow_pickle=False) for name in names}
+
+        # marks the artifact as recently used
+        os.utime(path)
+
+    except (FileNotFoundError, ValueError):
+        # not cached, or evicted by another worker while being read
+        return None
+
+    return arrays
+
+def save_artifact(cache, key, arrays):
+    """ Stores a dict of arrays under the key, then evicts old artifacts. No-op if cache is None or if the key is already cached """
+
+    if cache is None:
+        return
+
+    path = os.path.join(cache["dir"], key)
+
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        return
+
+    # written aside, then renamed, so that other workers never see a partial artifact
+    tmp_path = os.path.join(cache["dir"], ".tmp-{}".format(uuid.uuid4().hex))
+    os.makedirs(tmp_path)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), np.asarray(array), allow_pickle=False)
+
+    with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+        json.dump(list(arrays), f)
+
+    # what is left of an artifact without manifest, partly evicted or saved before the manifests, is replaced
+    shutil.rmtree(path, ignore_errors=True)
+
+    try:
+        os.rename(tmp_path, path)
+
+    except OSError:
+        # stored meanwhile by another worker
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if cache["bytes"] is not None:
+        cache["bytes"] += sum(np.asarray(array).nbytes for array in arrays.values())
+
+    if cache["bytes"] is None or cache["bytes"] > cache["max_bytes"] or time.time() - cache["scanned"] > SCAN_INTERVAL:
+        evict(cache)
+
+def get_artifacts(cache):
+    """ Returns (last use, size in bytes, path) of the cached artifacts """
+
+    artifacts = []
+
+    for entry in os.scandir(cache["dir"]):
+
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            artifacts.append((entry.stat().st_mtime, size, entry.path))
+
+        except FileNotFoundError:
+            pass
+
+    return artifacts
+
+def evict(cache):
+    """ Removes the least recently used artifacts until the cache fits in its size. Returns the number of bytes freed """
+
+    artifacts = sorted(get_artifacts(cache))
+    total = sum(size for _, size, _ in artifacts)
+    freed = 0
+
+    for _, size, path in artifacts:
+
+        if total - freed <= cache["max_bytes"]:
+            break
+
+        # the manifest goes first: an artifact left partly removed is then neither loaded nor taken as cached by save_artifact
+        try:
+            os.remove(os.path.join(path, MANIFEST_NAME))
+
+        except FileNotFoundError:
+            pass
+
+        shutil.rmtree(path, ignore_errors=True)
+        freed += size
+
+    cache["bytes"], cache["scanned"] = total - freed, time.time()
+
+    return freed
@@ -0,0 +1,201 @@
+import json
+import numpy as np
+import sys
+
+from src.modis_level1 import BANDS
+
+'''Streaming statistics of the swath channels over the extracted samples, to normalize the features without re-reading
+the dataset: per channel, the count, mean and sum of squared deviations (Welford) and the min / max of the valid values,
+and a histogram over fixed bins from which percentiles are estimated. They are kept by status of the swath ("daylight",
+"night", ...). Statistics are mergeable: each worker saves its partial statistics, which are merged into one summary:
+
+    python -m src.channel_stats <summary prefix> <partial.npz> [<partial.npz> ...]
+'''
+
+NB_BINS = 2000
+
+# emissive bands, calibrated to brightness temperatures; the other bands are reflectances in %
+EMISSIVE_BANDS = ['20', '21', '22', '23', '24', '25', '27', '28', '29', '30', '31', '32', '33', '34', '35', '36']
+
+FIELDS = ["count", "mean", "m2", "min", "max", "hist", "lower", "upper"]
+
+def get_channel_ranges():
+    """ Returns the (lower, upper) histogram range of each swath channel (BANDS, latitude, longitude); values outside are counted in the end bins """
+
+    ranges = []
+
+    for band in BANDS:
+
+        if band == "solar_zenith_angle":
+            ranges.append((0., 180.))
+        elif band in EMISSIVE_BANDS:
+            ranges.append((150., 350.))
+        else:
+            ranges.append((0., 160.))
+
+    return ranges + [(-90., 90.), (-180., 180.)]
+
+def new_stats(ranges=None, nb_bins=NB_BINS):
+    """
+    :param ranges: (lower, upper) histogram range of each channel, defaults to get_channel_ranges()
+    :return: empty stats dict of numpy arrays, updated by update_stats
+    """
+
+    if ranges is None:
+        ranges = get_channel_ranges()
+
+    nb_channels = len(ranges)
+    ranges = np.asarray(ranges, dtype=np.float64)
+
+    return {"count": np.zeros(nb_channels, dtype=np.int64), "mean": np.zeros(nb_channels), "m2": np.zeros(nb_channels),
+            "min": np.full(nb_channels, np.inf), "max": np.full(nb_channels, -np.inf), "hist": np.zeros((nb_channels, nb_bins), dtype=np.int64),
+            "lower": ranges[:, 0], "upper": ranges[:, 1]}
+
+def merge_stats(stats, other):
+    """ Returns the statistics of the union of the samples of two stats dicts with the same bins """
+
+    count = stats["count"] + other["count"]
+    delta = other["mean"] - stats["mean"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, stats["mean"] + delta * other["count"] / count, 0.)
+        m2 = np.where(count > 0, stats["m2"] + other["m2"] + delta ** 2 * stats["count"] * other["count"] / count, 0.)
+
+    return {"count": count, "mean": mean, "m2": m2, "min": np.minimum(stats["min"], other["min"]), "max": np.maximum(stats["max"], other["max"]),
+            "hist": stats["hist"] + other["hist"], "lower": stats["lower"], "upper": stats["upper"]}
+
+def get_batch_stats(values, lower, upper, nb_bins):
+    """
+    :param values: numpy.ndarray of size (nb_channels, nb_samples), NaNs are ignored
+    :return: the stats dict of the batch
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    nb_channels = values.shape[0]
+
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, np.where(valid, values, 0.).sum(axis=1) / count, 0.)
+
+    m2 = np.where(valid, values - mean[:, None], 0.)
+    m2 = (m2 * m2).sum(axis=1)
+
+    # one bincount over all channels, the bins of channel c being offset by c * nb_bins
+    width = (upper - lower) / nb_bins
+    bins = np.clip(np.floor((values - lower[:, None]) / width[:, None]), 0, nb_bins - 1)
+    bins = np.where(valid, bins, 0).astype(np.int64) + np.arange(nb_channels)[:, None] * nb_bins
+
+    hist = np.bincount(bins[valid], minlength=nb_channels * nb_bins).reshape(nb_channels, nb_bins)
+
+    return {"count": count, "mean": mean, "m2": m2, "min": np.where(valid, values, np.inf).min(axis=1, initial=np.inf),
+            "max": np.where(valid, values, -np.inf).max(axis=1, initial=-np.inf), "hist": hist, "lower": lower, "upper": upper}
+
+def update_stats(stats, values):
+    """
+    Adds the samples to the stats, in place
+    :param values: numpy.ndarray of size (nb_channels, nb_samples), e.g. the co-located swath pixels; NaNs are ignored
+    """
+
+    batch = get_batch_stats(values, stats["lower"], stats["upper"], stats["hist"].shape[1])
+
+    stats.update(merge_stats(stats, batch))
+
+def update_status_stats(all_stats, status, values):
+    """ Adds the samples of a swath to the stats of its status in all_stats, a dict of stats by status, in place """
+
+    if status not in all_stats:
+        all_stats[status] = new_stats()
+
+    update_stats(all_stats[status], values)
+
+def get_percentiles(stats, percentiles):
+    """
+    :param percentiles: sequence of percentiles in [0, 100]
+    :return: numpy.ndarray of size (nb_channels, len(percentiles)), interpolated in the histogram bins, NaN for channels without samples
+    """
+
+    nb_channels, nb_bins = stats["hist"].shape
+    width = (stats["upper"] - stats["lower"]) / nb_bins
+
+    result = np.full((nb_channels, len(percentiles)), np.nan)
+
+    for c in range(nb_channels):
+
+        if stats["count"][c] == 0:
+            continue
+
+        cdf = np.cumsum(stats["hist"][c])
+
+        for i, q in enumerate(percentiles):
+
+            target = q / 100. * cdf[-1]
+            b = min(np.searchsorted(cdf, target), nb_bins - 1)
+            below = cdf[b - 1] if b > 0 else 0
+
+            fraction = (target - below) / stats["hist"][c, b] if stats["hist"][c, b] > 0 else 0.
+            value = stats["lower"][c] + (b + fraction) * width[c]
+
+            # the end bins also hold the values out of the range
+            result[c, i] = np.clip(value, stats["min"][c], stats["max"][c])
+
+    return result
+
+def summarize(stats, percentiles=(1, 5, 25, 50, 75, 95, 99)):
+    """ Returns a JSON-serializable dict of per-channel lists: count, mean, std, min, max and percentiles """
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        std = np.sqrt(stats["m2"] / stats["count"])
+
+    empty = stats["count"] == 0
+
+    summary = {"count": stats["count"].tolist()}
+
+    for name, values in [("mean", stats["mean"]), ("std", std), ("min", stats["min"]), ("max", stats["max"])]:
+        summary[name] = [None if e else float(v) for v, e in zip(values, empty)]
+
+    summary["percentiles"] = {str(q): [None if np.isnan(v) else float(v) for v in column] for q, column in zip(percentiles, get_percentiles(stats, percentiles).T)}
+
+    return summary
+
+def save_stats(path, all_stats):
+    """ Saves a dict of stats by status as a .npz of arrays named "<status>.<field>" """
+
+    np.savez(path, **{"{}.{}".format(status, field): stats[field] for status, stats in all_stats.items() for field in FIELDS})
+
+def load_stats(path):
+    """ Returns the dict of stats by status saved by save_stats """
+
+    all_stats = {}
+
+    with np.load(path, allow_pickle=False) as arrays:
+        for name in arrays.files:
+
+            status, field = name.rsplit(".", 1)
+            all_stats.setdefault(status, {})[field] = arrays[name]
+
+    return all_stats
+
+def merge_files(paths):
+    """ Returns the merged dict of stats by status of several files saved by save_stats """
+
+    merged = {}
+
+    for path in paths:
+        for status, stats in load_stats(path).items():
+            merged[status] = merge_stats(merged[status], stats) if status in merged else stats
+
+    return merged
+
+if __name__ == "__main__":
+
+    prefix = sys.argv[1]
+    merged = merge_files(sys.argv[2:])
+
+    save_stats(prefix + ".npz", merged)
+
+    with open(prefix + ".json", "w") as f:
+        json.dump({"channels": BANDS + ["latitude", "longitude"], "stats": {status: summarize(stats) for status, stats in merged.items()}}, f, indent=1)
+
+    print("stats of {} files merged into {}.npz and {}.json".format(len(sys.argv) - 2, prefix, prefix))
@@ -1,3 +1,4 @@
+import datetime
 import glob
 import numpy as np
 import os
@@ -7,8 +8,10 @@ from pyhdf.SD import SD, SDC
 from pyhdf.HDF import HDF
 from pyhdf.VS import VS
 
-from src.track_alignment import get_track_oi, find_track_range, map_labels
-from src.utils import get_datetime, get_file_time_info
+from src import granule_cache
+from src.profiling import stage
+from src.track_alignment import get_track_oi, map_labels
+from src.utils import FLAG_DTYPE, get_datetime, get_file_time_info
 
 def find_cloudsat_by_day(abs_day, year, cloudsat_lidar_dir):
     """ returns list of filenames of specified day, and of previous and following day """
@@ -24,6 +27,14 @@ def find_cloudsat_by_day(abs_day, year, cloudsat_lidar_dir):
 
     return cloudsat_filenames
 
+def get_granule_datetime(cloudsat_filename):
+    """ Returns the start time of a cloudsat granule, from its AAAADDDHHMMSS_*.hdf filename """
+
+    cs_time_info = os.path.basename(cloudsat_filename)
+    year, day, hour, minute, second = int(cs_time_info[:4]), int(cs_time_info[4:7]), int(cs_time_info[7:9]), int(cs_time_info[9:11]), int(cs_time_info[11:13])
+
+    return get_datetime(year, day, hour, minute, second)
+
 def find_matching_cloudsat_files(radiance_filename, cloudsat_lidar_dir):
     """
     :param radiance_filename: the filename for the radiance .hdf, demarcated with "MYD02".
@@ -46,10 +57,7 @@ def find_matching_cloudsat_files(radiance_filename, cloudsat_lidar_dir):
 
     for filename in cloudsat_filenames:
         
-        cs_time_info = os.path.basename(filename)
-        year, day, hour, minute, second = int(cs_time_info[:4]), int(cs_time_info[4:7]), int(cs_time_info[7:9]), int(cs_time_info[9:11]), int(cs_time_info[11:13])
-
-        granule_dt = get_datetime(year, day, hour, minute, second)
+        granule_dt = get_granule_datetime(filename)
 
         if granule_dt <= swath_dt and (swath_dt - granule_dt).total_seconds() < 6000:
             prev_candidates[granule_dt] = filename
@@ -104,6 +112,22 @@ def get_coordinates(cloudsat_filenames, verbose=0):
     return np.array(all_latitudes), np.array(all_longitudes)
 
 
+def get_profile_times(cloudsat_path):
+    """ Returns the time of each profile of the granule (Profile_time), in seconds since the start of the granule """
+
+    f = HDF(cloudsat_path, SDC.READ)
+    vs = f.vstart()
+
+    vdata_time = vs.attach('Profile_time')
+    profile_times = np.array(vdata_time[:], dtype=np.float64).ravel()
+
+    vdata_time.detach()
+    vs.end()
+    f.close()
+
+    return profile_times
+
+
 def get_layer_information(cloudsat_filenames, get_quality=True, verbose=0):
     """ Returns
     CloudLayerType: -9: error, 0: non determined, 1-8 cloud types 
@@ -125,25 +149,35 @@ def get_layer_information(cloudsat_filenames, get_quality=True, verbose=0):
         CloudLayerBase = np.array(sd.select('CloudLayerBase').get())
         CloudLayerTop = np.array(sd.select('CloudLayerTop').get())
         
-        occurrences = np.zeros((layer_info.shape[0], 1))
-        print(CloudLayerBase.shape[0], CloudLayerBase.shape[1])
-        occ = 0 #occurrences[j]
+        occurrences = get_cloud_occurrences(CloudLayerBase, CloudLayerTop)
+
+
+    return occurrences
+
+
+def get_cloud_occurrences(CloudLayerBase, CloudLayerTop):
+    """
+    :param CloudLayerBase, CloudLayerTop: numpy.ndarray of size (nb_points, 10), layer base and top heights in km, negative after the last layer
+    :return occurrences: uint8 numpy.ndarray of size (nb_points, 1), the cloud label of each point of the track
+    """
+
+    occurrences = np.zeros((CloudLayerBase.shape[0], 1), dtype=FLAG_DTYPE)
+    occ = 0 #occurrences[j]
         
-        for i in range(CloudLayerBase.shape[0]):
-            #occ = 0 #occurrences[j]
-            nb_cloud_layer = np.where(CloudLayerBase[i,:] < 0 )[0][0]
-            #print(nb_cloud_layer)
-            for j in range(nb_cloud_layer):
+    for i in range(CloudLayerBase.shape[0]):
+        #occ = 0 #occurrences[j]
+        nb_cloud_layer = np.where(CloudLayerBase[i,:] < 0 )[0][0]
+        #print(nb_cloud_layer)
+        for j in range(nb_cloud_layer):
             
-                if CloudLayerBase.data[i,j] > 0 and CloudLayerTop.data[i,j] > 0.0:
-                    nb_cloud_height = CloudLayerTop.data[i,j] - CloudLayerBase.data[i,j]
-                    #print(nb_cloud_height)
+            if CloudLayerBase[i,j] > 0 and CloudLayerTop[i,j] > 0.0:
+                nb_cloud_height = CloudLayerTop[i,j] - CloudLayerBase[i,j]
+                #print(nb_cloud_height)
                 
-                    if nb_cloud_height > 0:
-                        occ = 1 
+                if nb_cloud_height > 0:
+                    occ = 1 
             
-            occurrences[i] = occ
-
+        occurrences[i] = occ
 
     return occurrences
 
@@ -179,61 +213,149 @@ def get_class_occurrences(layer_types):
                
     return occurrences    
 
-def get_cloudsat_mask(l1_filename, cloudsat_lidar_dir, cloudsat_dir, swath_latitudes, swath_longitudes, map_label=True):
+def find_cloudsat_files(l1_filename, cloudsat_lidar_dir, cloudsat_dir):
+    """
+    :return cloudsat_filenames, get_quality: the tuple of cloudsat granules matching the swath, and whether their layer quality is available
+    Swaths with the same result belong to the same orbit, and can share the track read by read_cloudsat_granules.
+    """
 
-    # retrieve cloudsat files content
     if cloudsat_lidar_dir is None:
-
-        cloudsat_filenames = find_matching_cloudsat_files(l1_filename, cloudsat_dir)
         # LayerTypeQuality not available in CS_2B-CLDCLASS_GRANULE_P1_R05_E02_F00 files
-        layer_info = get_layer_information(cloudsat_filenames, get_quality=False) 
+        return tuple(find_matching_cloudsat_files(l1_filename, cloudsat_dir)), False
 
-    else:
+    return tuple(find_matching_cloudsat_files(l1_filename, cloudsat_lidar_dir)), True
+
+def decode_cloudsat_granule(cloudsat_path):
+    """
+    :return: dict of the latitudes and longitudes (nb_points, 1), profile times (nb_points,) and cloud occurrences (nb_points, 1) of a cloudsat granule
+    """
 
-        cloudsat_filenames = find_matching_cloudsat_files(l1_filename, cloudsat_lidar_dir)
+    latitudes, longitudes = get_coordinates([cloudsat_path])
+    occurrences = get_layer_information([cloudsat_path])
 
-            
-        layer_info = get_layer_information(cloudsat_filenames, get_quality=True)
-        #print("layerinfo", layer_info)
+    return {"latitudes": latitudes, "longitudes": longitudes, "profile_times": get_profile_times(cloudsat_path), "occurrences": occurrences}
+
+def load_cloudsat_granule(cloudsat_path):
+    """ Returns the decoded granule (see decode_cloudsat_granule) through the in-process cache, keyed by path and modification time """
+
+    key = (os.path.abspath(cloudsat_path), os.stat(cloudsat_path).st_mtime_ns)
+
+    return granule_cache.get_granule(key, lambda: decode_cloudsat_granule(cloudsat_path))
+
+def get_track_in_window(cloudsat_filenames, start, end):
+    """
+    :param start, end: datetimes of the time window
+    :return cs_latitudes, cs_longitudes: numpy.ndarray of size (nb_points,), the profiles of the granules acquired within the window
+    """
+
+    all_latitudes, all_longitudes = [], []
+
+    for cloudsat_path in cloudsat_filenames:
+
+        granule = load_cloudsat_granule(cloudsat_path)
+        granule_dt = get_granule_datetime(cloudsat_path)
+
+        in_window = (granule["profile_times"] >= (start - granule_dt).total_seconds()) & (granule["profile_times"] <= (end - granule_dt).total_seconds())
 
-    # focus around cloudsat track
-    cs_latitudes, cs_longitudes = get_coordinates(cloudsat_filenames)
+        all_latitudes.append(granule["latitudes"][in_window, 0])
+        all_longitudes.append(granule["longitudes"][in_window, 0])
+
+    return np.concatenate(all_latitudes), np.concatenate(all_longitudes)
+
+def get_track_times(cloudsat_filenames):
+    """ Returns the acquisition time of each profile of the granules, in seconds since 1970-01-01 UTC, in the order of read_cloudsat_granules """
+
+    all_times = []
+
+    for cloudsat_path in cloudsat_filenames:
+
+        start = (get_granule_datetime(cloudsat_path) - datetime.datetime(1970, 1, 1)).total_seconds()
+        all_times.append(start + load_cloudsat_granule(cloudsat_path)["profile_times"])
+
+    return np.concatenate(all_times)
+
+def save_layer_info(path, occurrences, mapping, cs_range, profile_times=None):
+    """
+    Saves the layer info of the co-located pixels as named typed arrays in a .npz, which loads lazily and without pickle (see load_layer_info)
+    :param occurrences: uint8 numpy.ndarray of size (nb_pixels, 1), the cloud occurrences
+    :param mapping: numpy.ndarray of size (nb_pixels, 3), the swath row, swath column and cloudsat profile index of each pixel, as returned by get_track_oi
+    :param cs_range: minimal and maximal swath columns of the track
+    :param profile_times: optional acquisition time of each pixel's profile, in seconds since 1970-01-01 UTC; NaN if not given
+    """
+
+    mapping = np.asarray(mapping).reshape(-1, 3)
+
+    if profile_times is None:
+        profile_times = np.full(mapping.shape[0], np.nan)
+
+    np.savez(path, occurrences=np.asarray(occurrences, dtype=FLAG_DTYPE), rows=mapping[:, 0].astype(np.int32), cols=mapping[:, 1].astype(np.int32),
+             profile_indices=mapping[:, 2].astype(np.int32), cs_range=np.asarray(cs_range, dtype=np.int32), profile_times=np.asarray(profile_times, dtype=np.float64))
+
+def load_layer_info(path):
+    """
+    :return: the layer info saved by save_layer_info, a read-only mapping of names to arrays, each read when it is first accessed
+    Layer infos saved as .npy before, holding only the occurrences array, are returned as {"occurrences": array}.
+    """
+
+    if path.endswith(".npy"):
+        return {"occurrences": np.load(path, allow_pickle=False)}
+
+    return np.load(path, allow_pickle=False)
+
+def read_cloudsat_granules(cloudsat_filenames, get_quality=True):
+    """
+    :return cs_latitudes, cs_longitudes, layer_info: coordinates and cloud occurrences along the cloudsat granules
+    The granules are decoded once per worker, and shared through src.granule_cache.
+    """
+
+    granules = [load_cloudsat_granule(cloudsat_path) for cloudsat_path in cloudsat_filenames]
+
+    # focus around cloudsat track; the occurrences are concatenated as the coordinates, so that the profile indices of the alignment index both
+    cs_latitudes = np.concatenate([granule["latitudes"] for granule in granules])
+    cs_longitudes = np.concatenate([granule["longitudes"] for granule in granules])
+    layer_info = np.concatenate([granule["occurrences"] for granule in granules])
+
+    return cs_latitudes, cs_longitudes, layer_info
+
+def read_cloudsat_track(l1_filename, cloudsat_lidar_dir, cloudsat_dir):
+    """
+    :return cs_latitudes, cs_longitudes, layer_info: coordinates and cloud occurrences of the cloudsat granules matching the swath
+    """
+
+    # retrieve cloudsat files content
+    cloudsat_filenames, get_quality = find_cloudsat_files(l1_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+    return read_cloudsat_granules(cloudsat_filenames, get_quality=get_quality)
+
+def get_cloudsat_mask(l1_filename, cloudsat_lidar_dir, cloudsat_dir, swath_latitudes, swath_longitudes, map_label=True, record=None, track=None):
+    """
+    :param map_label: if True, the layer info is returned as a label raster over the swath (see src.track_alignment.map_labels), along the track otherwise
+    :param track: optional (cs_latitudes, cs_longitudes, layer_info) as returned by read_cloudsat_track, read from the files otherwise
+    """
+
+    if track is None:
+        with stage(record, "cloudsat_read"):
+            track = read_cloudsat_track(l1_filename, cloudsat_lidar_dir, cloudsat_dir)
+
+    cs_latitudes, cs_longitudes, layer_info = track
  
-    cs_range, mapping, mapping_a, mapping_b, mapping_c = get_track_oi(cs_latitudes, cs_longitudes, swath_latitudes, swath_longitudes)
+    with stage(record, "alignment"):
+        cs_range, mapping, mapping_a, mapping_b, mapping_c = get_track_oi(cs_latitudes, cs_longitudes, swath_latitudes, swath_longitudes)
     #cs_latitudes, cs_longitudes = cs_latitudes[toi_indices], cs_longitudes[toi_indices]
     #lat, lon = swath_latitudes[:, cs_range[0]:cs_range[1]], swath_longitudes[:, cs_range[0]:cs_range[1]]
    
     
     layer_info = layer_info[mapping_c]
     
-    zero_inds = np.where(layer_info == 0)[0]
-    non_zero_inds = np.where(layer_info > 0)[0]
-    
-    inds = np.append(zero_inds[:len(non_zero_inds)],non_zero_inds)
-    print(inds.shape, zero_inds.shape, non_zero_inds.shape)
+    # the samples are subsampled by class with src.sampling, by the caller
     #cloud_occurrences = get_class_occurrences(layer_info)
     
 
 
 
     if map_label:
-        #cloud_occurrences = get_class_occurrences(layer_info)
-        cloudsat_mask = map_labels(mapping, cloud_occurrences, lat.shape)
-        #print(cloudsat_mask.shape)
-
-        # remove labels on egdes
-        #cloudsat_mask[:10] = 0
-        #cloudsat_mask[:-11:-1] = 0
-
-        #print("retrieved", np.sum(cloudsat_mask > 0), "labels")
-        
-        # go back to initial swath size
-        ext_cloudsat_mask = np.zeros((*(lat.shape), 1))
-        #print(ext_cloudsat_mask.shape)
-        ext_cloudsat_mask = cloudsat_mask
-        cloudsat_result = ext_cloudsat_mask.transpose(2, 0, 1).astype(np.uint8)
-        
-        #print(ext_cloudsat_mask.shape, cloudsat_result.shape)
+        # uint8 raster of size (1, HEIGHT, WIDTH) of the cloud occurrences over the swath, 0 away from the track
+        cloudsat_result = map_labels(mapping, layer_info, swath_latitudes.shape)
 
         return cs_range, mapping, mapping_a, mapping_b, cloudsat_result
     
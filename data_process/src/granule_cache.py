@@ -0,0 +1,88 @@
+import threading
+
+from collections import OrderedDict
+
+'''In-process LRU cache of decoded granules, bounded by the memory of the cached arrays. Consecutive swaths processed by
+a worker overlap the same CloudSat granule, which is then decoded only once. The hit and miss counters help sizing it.'''
+
+# ~250 decoded CloudSat granules
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+_cache = {"entries": OrderedDict(), "nbytes": 0, "max_bytes": DEFAULT_MAX_BYTES, "hits": 0, "misses": 0, "evictions": 0}
+
+# the cache is shared by the prefetching thread and the main thread
+_lock = threading.Lock()
+
+def get_nbytes(granule):
+    """ Returns the memory held by the arrays of a decoded granule (dict of numpy arrays) """
+
+    return sum(array.nbytes for array in granule.values())
+
+def get_granule(key, decode):
+    """
+    :param key: hashable identifying the granule and its version, e.g. (path, mtime)
+    :param decode: function returning the decoded granule, a dict of numpy arrays, called on a miss
+    :return: the decoded granule, whose arrays are read-only as they are shared by all callers
+    """
+
+    with _lock:
+
+        if key in _cache["entries"]:
+            _cache["hits"] += 1
+            _cache["entries"].move_to_end(key)
+
+            return _cache["entries"][key]
+
+        _cache["misses"] += 1
+
+    # decoded outside of the lock, so that a slow read does not block the other thread's hits
+    granule = decode()
+
+    for array in granule.values():
+        array.flags.writeable = False
+
+    with _lock:
+
+        if key not in _cache["entries"]:
+            _cache["entries"][key] = granule
+            _cache["nbytes"] += get_nbytes(granule)
+
+            _evict()
+
+    return granule
+
+def _evict():
+
+    # the most recent granule is kept even if it exceeds the bound on its own
+    while _cache["nbytes"] > _cache["max_bytes"] and len(_cache["entries"]) > 1:
+
+        key, granule = _cache["entries"].popitem(last=False)
+
+        _cache["nbytes"] -= get_nbytes(granule)
+        _cache["evictions"] += 1
+
+def set_max_bytes(max_bytes):
+    """ Sets the memory bound of the cache, 0 to disable it """
+
+    with _lock:
+        _cache["max_bytes"] = max_bytes
+
+        if max_bytes <= 0:
+            _cache["entries"].clear()
+            _cache["nbytes"] = 0
+        else:
+            _evict()
+
+def get_stats():
+    """ Returns the hits, misses and evictions so far, and the number of entries and bytes currently cached """
+
+    with _lock:
+        return {"hits": _cache["hits"], "misses": _cache["misses"], "evictions": _cache["evictions"],
+                "entries": len(_cache["entries"]), "nbytes": _cache["nbytes"], "max_bytes": _cache["max_bytes"]}
+
+def clear():
+
+    with _lock:
+        _cache["entries"].clear()
+        _cache["nbytes"] = 0
+        _cache["hits"] = _cache["misses"] = _cache["evictions"] = 0
@@ -1,7 +1,14 @@
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from scipy import interpolate
 
+# number of detectors (rows) per MODIS 1km scan
+SCAN_ROWS = 10
+
+# griddata method filling the gaps left by the "stripes" method
+STRIPES_FALLBACK = "nearest"
+
 def all_invalid(array, tol=5e-2):
     """ Checks if 3d array contains all invalid values.
         :param tol: tollerance ratio of invalid values 
@@ -13,6 +20,16 @@ def all_invalid(array, tol=5e-2):
 
     return np.sum(masked_array.mask) >= c * cols * rows * tol 
 
+def get_invalid_fractions(swath):
+    """ Returns the fraction of invalid (NaN) values of each channel of a swath of size (nb_channels, height, width), in one pass over the stack """
+
+    return np.count_nonzero(np.isnan(swath), axis=(1, 2)) / max(swath.shape[1] * swath.shape[2], 1)
+
+def get_fillable_channels(swath):
+    """ Returns the indices of the channels holding valid values: channels without any, as the visible bands at night, cannot be filled """
+
+    return list(np.flatnonzero(get_invalid_fractions(swath) < 1))
+
 def contain_invalid(masked_array):
     """Checks to see if the array contain any 1s, which would indicate NaNs in the swath."""
 
@@ -37,11 +54,96 @@ def fill_channel(masked_array, xx, yy, method="nearest"):
 
     return inter
 
-def fill_all_channels(swath, method="nearest"):
+def fill_gaps(channel, xx, yy, method="nearest"):
+    """
+        Inplace function: fills the invalid values of a channel by spatial interpolation of the valid ones, as fill_channel,
+        but only interpolating at the invalid pixels, which is cheaper when they are few
+        :param channel (numpy.array): array of size (height, width)
+    """
+
+    invalid = np.isnan(channel)
+
+    channel[invalid] = interpolate.griddata((xx[~invalid], yy[~invalid]), channel[~invalid], (xx[invalid], yy[invalid]), method=method, fill_value=True)
+
+def fill_stripes(channel, scan_rows=SCAN_ROWS):
+    """
+        Inplace function: fills the rows of a channel that are entirely invalid, as those of the dead detectors of Aqua band 6,
+        by linear interpolation between the nearest valid rows of the same scan, or by a copy of the only one
+        :param channel (numpy.array): array of size (height, width), whose first row is the first detector of a scan
+        :return: the number of rows filled; rows without valid rows in their scan, as missing scans, are left invalid
+    """
+
+    height = channel.shape[0]
+    rows = np.arange(height)
+
+    bad = np.isnan(channel).all(axis=1)
+
+    if not bad.any():
+        return 0
+
+    # nearest valid row above and below each row, kept only if it is in the same scan
+    above = np.maximum.accumulate(np.where(bad, -1, rows))
+    below = np.minimum.accumulate(np.where(bad, height, rows)[::-1])[::-1]
+
+    scans = rows // scan_rows
+    has_above = (above >= 0) & (scans[np.maximum(above, 0)] == scans)
+    has_below = (below < height) & (scans[np.minimum(below, height - 1)] == scans)
+
+    above = np.where(has_above, above, below)
+    below = np.where(has_below, below, above)
+
+    to_fill = np.flatnonzero(bad & (has_above | has_below))
+
+    above, below = above[to_fill], below[to_fill]
+    weights = np.where(below > above, (to_fill - above) / np.maximum(below - above, 1), 0.)[:, None]
+
+    channel[to_fill] = (1 - weights) * channel[above] + weights * channel[below]
+
+    return to_fill.shape[0]
+
+def fill_swath_channel(swath, i, xx, yy, method="nearest"):
+    """
+        Inplace function: fills the invalid values of channel i of the swath
+        :param method: a scipy.interpolate.griddata method, or "stripes" to fill the invalid detector rows with fill_stripes first,
+        and the remaining gaps with fill_gaps and STRIPES_FALLBACK
+        :return: True if the channel has been filled or was already full
+    """
+
+    masked_array = np.ma.masked_invalid(swath[i])
+
+    if contain_invalid(masked_array) and method == "stripes":
+
+        fill_stripes(swath[i])
+
+        try:
+            if np.isnan(swath[i]).any():
+                fill_gaps(swath[i], xx, yy, STRIPES_FALLBACK)
+
+            return True
+
+        except:
+            return False
+
+    if contain_invalid(masked_array):
+            
+        try:
+            inter = fill_channel(masked_array, xx, yy, method)
+            swath[i] = inter
+
+            return True
+            
+        except:
+            return False
+
+    return True
+
+def fill_all_channels(swath, method="nearest", n_workers=1, channels=None):
     """ 
         Inplace function: it fills all invalid valued by spatial interpolation a channel at a time
         :param swath (numpy.array): array of size (nb_channels, height, width) 
-        :param method (string): method for the interpolation. Check scipy.interpolate.griddata for possible methods
+        :param method (string): method for the interpolation. Check scipy.interpolate.griddata for possible methods, or "stripes" (see fill_swath_channel)
+        :param n_workers (int): number of threads filling channels concurrently. Channels are independent, and scipy releases the GIL in its spatial queries
+        :param channels: indices of the channels to fill, by default those holding valid values (see get_fillable_channels); the others are left as they are
         :return: list of channels that have been filled or were already full
     """
 
@@ -50,26 +152,19 @@ def fill_all_channels(swath, method="nearest"):
     x, y = np.arange(0, swath_shape[2]), np.arange(0, swath_shape[1])
     xx, yy = np.meshgrid(x, y)
 
-    full_channels = []
-
-    for i, ch_array in enumerate(swath):
+    if channels is None:
+        channels = get_fillable_channels(swath)
 
-        masked_array = np.ma.masked_invalid(ch_array)
+    if n_workers > 1:
 
-        if contain_invalid(masked_array):
-            
-            try:
-                inter = fill_channel(masked_array, xx, yy, method)
-                swath[i] = inter
-
-                full_channels.append(i)
-            
-            except:
-                pass
+        # each thread writes its own channel of the swath; results come back in channel order
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            filled = list(executor.map(lambda i: fill_swath_channel(swath, i, xx, yy, method), channels))
 
-        else:
+    else:
+        filled = [fill_swath_channel(swath, i, xx, yy, method) for i in channels]
 
-            full_channels.append(i)
+    full_channels = [i for i, full in zip(channels, filled) if full]
 
     return full_channels
 
@@ -0,0 +1,134 @@
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+'''Persistent run ledger: a single-file SQLite database with one row per granule, recording its processing state,
+output path and timings. Workers update it transactionally, and the state of a granule is a primary key lookup,
+so resuming an interrupted batch run does not require walking the output tree.'''
+
+PENDING, RUNNING, DONE, FAILED, SKIPPED = "pending", "running", "done", "failed", "skipped"
+
+LEDGER_NAME = "ledger.sqlite"
+
+def open_ledger(ledger_path, timeout=60):
+    """
+    :param ledger_path: path of the SQLite database, created if it does not exist
+    :param timeout: seconds to wait for a lock held by another worker
+    :return: sqlite3 connection to the ledger
+    """
+
+    connection = sqlite3.connect(ledger_path, timeout=timeout, isolation_level=None)
+
+    # write-ahead logging lets readers proceed while a worker commits
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS granules (
+                            granule TEXT PRIMARY KEY,
+                            state TEXT NOT NULL,
+                            input_path TEXT,
+                            output_path TEXT,
+                            started REAL,
+                            finished REAL,
+                            duration REAL,
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            error TEXT)""")
+
+    return connection
+
+@contextmanager
+def transaction(connection):
+    """ Takes the database write lock up front, so that check-then-update sequences are atomic across workers """
+
+    connection.execute("BEGIN IMMEDIATE")
+
+    try:
+        yield connection
+
+    except:
+        connection.execute("ROLLBACK")
+        raise
+
+    else:
+        connection.execute("COMMIT")
+
+def get_state(connection, granule):
+    """ Returns the state of the granule, or None if it was never registered """
+
+    row = connection.execute("SELECT state FROM granules WHERE granule = ?", (granule,)).fetchone()
+
+    return None if row is None else row[0]
+
+def add_granules(connection, granules):
+    """ Registers granules as pending, leaving already known granules untouched """
+
+    with transaction(connection):
+        connection.executemany("INSERT OR IGNORE INTO granules (granule, state) VALUES (?, ?)", [(granule, PENDING) for granule in granules])
+
+def claim_granule(connection, granule, input_path=None):
+    """
+    :param granule: name identifying the granule, e.g. the output filename
+    :param input_path: the MYD02 file of the granule
+    :return: True if the granule was marked as running by this call, False if it is already done or running in another worker
+    """
+
+    with transaction(connection):
+
+        state = get_state(connection, granule)
+
+        if state in (RUNNING, DONE):
+            return False
+
+        connection.execute("""INSERT INTO granules (granule, state, input_path, started, attempts) VALUES (?, ?, ?, ?, 1)
+                              ON CONFLICT(granule) DO UPDATE SET state = excluded.state, input_path = COALESCE(excluded.input_path, input_path),
+                              started = excluded.started, finished = NULL, duration = NULL, error = NULL, attempts = attempts + 1""",
+                           (granule, RUNNING, input_path, time.time()))
+
+    return True
+
+def _finish_granule(connection, granule, state, output_path=None, error=None):
+
+    now = time.time()
+
+    with transaction(connection):
+        connection.execute("UPDATE granules SET state = ?, output_path = ?, error = ?, finished = ?, duration = ? - started WHERE granule = ?",
+                           (state, output_path, error, now, now, granule))
+
+def mark_done(connection, granule, output_path):
+
+    _finish_granule(connection, granule, DONE, output_path=output_path)
+
+def mark_failed(connection, granule, error):
+
+    _finish_granule(connection, granule, FAILED, error=str(error))
+
+def mark_skipped(connection, granule, reason):
+    """ Records a granule that is not worth processing, e.g. rejected by a pre-filter, with the reason in the error column """
+
+    with transaction(connection):
+        connection.execute("""INSERT INTO granules (granule, state, error, finished) VALUES (?, ?, ?, ?)
+                              ON CONFLICT(granule) DO UPDATE SET state = excluded.state, error = excluded.error, finished = excluded.finished""",
+                           (granule, SKIPPED, reason, time.time()))
+
+def reset_stale(connection, max_age):
+    """ Puts granules left running for more than max_age seconds (e.g. by a killed worker) back to pending """
+
+    with transaction(connection):
+        cursor = connection.execute("UPDATE granules SET state = ? WHERE state = ? AND started < ?", (PENDING, RUNNING, time.time() - max_age))
+
+    return cursor.rowcount
+
+def get_granules(connection, state):
+    """ Returns the names of all granules in the given state """
+
+    return [row[0] for row in connection.execute("SELECT granule FROM granules WHERE state = ? ORDER BY granule", (state,))]
+
+def import_outputs(connection, save_dir, pattern="*.nc"):
+    """ One-off migration: walks save_dir once and records the existing outputs as done """
+
+    outputs = [(path.name, DONE, str(path)) for path in Path(save_dir).rglob(pattern)]
+
+    with transaction(connection):
+        connection.executemany("INSERT OR IGNORE INTO granules (granule, state, output_path) VALUES (?, ?, ?)", outputs)
+
+    return len(outputs)
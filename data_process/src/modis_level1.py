@@ -2,10 +2,25 @@ import glob
 import numpy as np
 import os
 import pyhdf
+from pyhdf.SD import SD, SDC
 from satpy import Scene
 
+from src.utils import RADIANCE_DTYPE, GEOLOCATION_DTYPE
+
 MAX_WIDTH, MAX_HEIGHT = 1354, 2040
 
+# bands selected from MODIS
+BANDS = ['1', '2', '3', '4', '5', '6', '7', '8', '8', '10', '11', '12', '13lo','13hi', '14lo','14hi', '15', '16', '17', '18', '19', '20', '21','22','23','24','25','26','27','28','29','30','31','32','33','34','35','36','solar_zenith_angle']
+
+# the bands followed by latitude and longitude
+NB_SWATH_CHANNELS = len(BANDS) + 2
+
+# number of rows (detectors) per 1km MODIS scan
+SCAN_ROWS = 10
+
+# acquisition time of a MODIS granule, in seconds
+SWATH_DURATION = 300
+
 def find_matching_geoloc_file(radiance_filename, myd03_dir):
     """
     :param radiance_filename: the filename for the radiance .hdf, demarcated with "MYD02".
@@ -38,21 +53,62 @@ def find_all_radiance_geoloc_pairs(path):
 
     return pairs
 
-def get_swath(radiance_filename, myd03_dir):
+def get_edge_geolocation(radiance_filename, myd03_dir, step=10):
+    """
+    :param radiance_filename: MYD02 filename
+    :param myd03_dir: root directory of MYD03 geolocational files
+    :param step: one edge pixel in step is kept
+    :return latitudes, longitudes: outline of the swath, read from the first and last rows and columns of the MYD03 file,
+    ordered around the swath (top row, right column, bottom row and left column), without the fill values
+    Only the edges are read, so it is much cheaper than the scene of get_swath.
+    """
+
+    geoloc_file = SD(find_matching_geoloc_file(radiance_filename, myd03_dir), SDC.READ)
+
+    edges = []
+
+    for name in ['Latitude', 'Longitude']:
+
+        sds = geoloc_file.select(name)
+        height, width = sds.info()[2]
+
+        top, bottom = sds[0, :], sds[height - 1, :]
+        left, right = sds[:, 0], sds[:, width - 1]
+
+        sds.endaccess()
+
+        edges.append(np.concatenate([top[::step], right[::step], bottom[::-step], left[::-step]]).astype(np.float64))
+
+    geoloc_file.end()
+
+    latitudes, longitudes = edges
+    valid = (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+
+    return latitudes[valid], longitudes[valid]
+
+def get_swath(radiance_filename, myd03_dir, out=None):
     """
     :param radiance_filename: MYD02 filename
     :param myd03_dir: root directory of MYD03 geolocational files
-    :return swath: numpy.ndarray of size (15, HEIGHT, WIDTH) 
+    :param out: optional float32 buffer of size (41, >= HEIGHT, >= WIDTH) the channels are written into, e.g. a slice of a larger swath buffer
+    :return swath: float32 numpy.ndarray of size (41, HEIGHT, WIDTH), a view of out if it is given
     Uses the satpy Scene reader with the modis-l1b files. Issues reading files might be due to pyhdf not being
     installed - otherwise try pip install satpy[modis_0l1b]
     Creates a scene with the MYD02 and MYD03 files, and extracts them as multi-channel arrays. The lat and long are
     are appended as additional channels.
     """
 
-    # bands selected from MODIS
-    composite = ['1', '2', '3', '4', '5', '6', '7', '8', '8', '10', '11', '12', '13lo','13hi', '14lo','14hi', '15', '16', '17', '18', '19', '20', '21','22','23','24','25','26','27','28','29','30','31','32','33','34','35','36','solar_zenith_angle']
-     
-    
+    global_scene = load_swath_scene(radiance_filename, myd03_dir)
+
+    return read_swath(global_scene, out=out)
+
+def load_swath_scene(radiance_filename, myd03_dir):
+    """
+    :param radiance_filename: MYD02 filename
+    :param myd03_dir: root directory of MYD03 geolocational files
+    :return: satpy Scene with the BANDS, latitude and longitude loaded at 1km. The data is lazy: nothing is read until read_swath or read_geolocation
+    """
+
     # find a corresponding geolocational (MYD03) file for the provided radiance (MYD02) file
     geoloc_filename = find_matching_geoloc_file(radiance_filename, myd03_dir)
 
@@ -60,23 +116,64 @@ def get_swath(radiance_filename, myd03_dir):
     global_scene = Scene(reader='modis_l1b', filenames=[radiance_filename, geoloc_filename])
 
     # load composite, resolution of 1km
-    global_scene.load(composite, resolution=1000)
+    global_scene.load(BANDS, resolution=1000)
 
     # load latitudes and longitudes, resolution 1km
     global_scene.load(['latitude', 'longitude'], resolution=1000)
-    latitude = np.array(global_scene['latitude'].load())
-    longitude = np.array(global_scene['longitude'].load())
 
-    swath = []
+    return global_scene
+
+def read_geolocation(global_scene):
+    """ Returns the float32 latitudes and longitudes of the scene, of size (HEIGHT, WIDTH) """
+
+    latitude = np.asarray(global_scene['latitude'][:MAX_HEIGHT, :MAX_WIDTH].values, dtype=GEOLOCATION_DTYPE)
+    longitude = np.asarray(global_scene['longitude'][:MAX_HEIGHT, :MAX_WIDTH].values, dtype=GEOLOCATION_DTYPE)
+
+    return latitude, longitude
+
+def read_swath(global_scene, out=None, start=0, stop=MAX_HEIGHT):
+    """
+    :param global_scene: scene returned by load_swath_scene
+    :param out: optional float32 buffer of size (41, >= stop - start, >= WIDTH) the channels are written into
+    :param start, stop: range of swath rows to read; only these rows are computed from the files
+    :return swath: float32 numpy.ndarray of size (41, rows, WIDTH), a view of out if it is given
+    """
+
+    stop = min(stop, MAX_HEIGHT)
+
+    latitude = np.asarray(global_scene['latitude'][start:stop, :MAX_WIDTH].values, dtype=GEOLOCATION_DTYPE)
+    longitude = np.asarray(global_scene['longitude'][start:stop, :MAX_WIDTH].values, dtype=GEOLOCATION_DTYPE)
+
+    height, width = latitude.shape
+
+    if out is None:
+        out = np.empty((NB_SWATH_CHANNELS, height, width), dtype=RADIANCE_DTYPE)
+
+    # each channel is copied once, straight into its slice of the buffer
+    for i, comp in enumerate(BANDS):
+        out[i, :height, :width] = np.asarray(global_scene[comp][start:stop, :width].values)
+
+    out[-2, :height, :width] = latitude
+    out[-1, :height, :width] = longitude
+
+    return out[:, :height, :width]
+
+def scan_blocks(height, block_rows, halo=SCAN_ROWS):
+    """
+    :param height: number of rows of the swath
+    :param block_rows: number of rows per block, rounded down to whole MODIS scans
+    :param halo: number of rows read on each side of a block, rounded up to whole scans
+    :return: generator of (start, stop, halo_start, halo_stop): the rows of each block, and the rows read with its halo
+    """
+
+    block_rows = max(SCAN_ROWS, block_rows - block_rows % SCAN_ROWS)
+    halo = -(-halo // SCAN_ROWS) * SCAN_ROWS
 
-    for comp in composite:
-        temp = np.array(global_scene[comp].load())
-        swath.append(temp[:MAX_HEIGHT, :MAX_WIDTH])
+    for start in range(0, height, block_rows):
 
-    swath.append(latitude[:MAX_HEIGHT, :MAX_WIDTH])
-    swath.append(longitude[:MAX_HEIGHT, :MAX_WIDTH])
+        stop = min(height, start + block_rows)
 
-    return np.array(swath, dtype=np.float32)
+        yield start, stop, max(0, start - halo), min(height, stop + halo)
 
 def get_swath_rgb(radiance_filename, myd03_dir, composite='true_color'):
     """
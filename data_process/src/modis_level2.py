@@ -5,13 +5,18 @@ import os
 from pyhdf.SD import SD, SDC
 from satpy import Scene
 
+from src.utils import FLAG_DTYPE, FLAG_FILL_VALUE
+
 '''take in the MODIS level 1 filename to get the information needed to find the corresponding MODIS level 2 filename.
 This info includes the YYYY and day in year (ex: AYYYYDIY) and then the time of the pass (ex1855)
 It returns the full level 2 filename path'''
 
 MAX_WIDTH, MAX_HEIGHT = 1354, 2040
 
-def bits_stripping(bit_start,bit_count,value):
+# the cloud mask followed by the 24 decoded flags
+NB_MASK_CHANNELS = 25
+
+def bits_stripping(bit_start,bit_count,value,out=None):
     """Extract specified bit from bit representation of integer value.
     Parameters
     ----------
@@ -21,33 +26,81 @@ def bits_stripping(bit_start,bit_count,value):
         Number of bits starting from bit_start to extract
     value : int
         Number from which to extract the bits
+    out : numpy.ndarray, optional
+        Array the result is written into
     Returns
     -------
         int
         Value of the extracted bits
     """
     bitmask=pow(2,bit_start+bit_count)-1
-    return np.right_shift(np.bitwise_and(value,bitmask),bit_start)
+    out = np.bitwise_and(value,bitmask,out=out)
+    return np.right_shift(out,bit_start,out=out)
 
-def get_cloud_mask(l1_filename, cloud_mask_dir):
+def get_cloud_mask(l1_filename, cloud_mask_dir, out=None):
     
-    """ return a mask, with 0 for cloudy, 1 for uncertain/probably cloudy, 2 for probably clear, and 3 for clear. """
-    
-    basename = os.path.split(l1_filename)
+    """ return a uint8 mask of size (25, HEIGHT, WIDTH): the cloud mask, with 0 for cloudy, 1 for uncertain/probably cloudy, 2 for probably clear, and 3 for clear, followed by the decoded flags.
+        If out, a uint8 buffer of size (25, >= HEIGHT, >= WIDTH), is given, the channels are written into it and a view of it is returned. """
+
+    cloud_mask, cloud_flag = open_cloud_mask(l1_filename, cloud_mask_dir)
+
+    return read_cloud_mask(cloud_mask, cloud_flag, out)
+
+def find_cloud_mask_file(l1_filename, cloud_mask_dir):
+    """ Returns the MYD35 file with the same acquisition time (AYYYYDDD.HHMM) as the MYD02 file """
+
+    return glob.glob(os.path.join(cloud_mask_dir, 'MYD35*' + l1_filename.split('.A')[1][:12] + '*'))[0]
 
-    cloud_mask_filename = glob.glob(os.path.join(cloud_mask_dir, 'MYD35*' + l1_filename.split('.A')[1][:12] + '*'))[0]
+def open_cloud_mask(l1_filename, cloud_mask_dir):
+    """
+    :return: the lazy satpy cloud mask and the MYD35 Cloud_Mask SDS of the granule, read by read_cloud_mask
+    """
+
+    cloud_mask_filename = find_cloud_mask_file(l1_filename, cloud_mask_dir)
     
     # satpy returns(0=Cloudy, 1=Uncertain, 2=Probably Clear, 3=Confident Clear)
     swath = Scene(reader = 'modis_l2', filenames = [cloud_mask_filename])
     swath.load(['cloud_mask'], resolution = 1000)
     
-    cloud_mask = np.array(swath['cloud_mask'].load())[:MAX_HEIGHT, :MAX_WIDTH]
-    
-
-    cloud_mask = cloud_mask.astype(np.intp)
-    
+    # the SDS keeps its file open
     file = SD(cloud_mask_filename, SDC.READ)
     cloud_flag = file.select('Cloud_Mask')
+
+    return swath['cloud_mask'], cloud_flag
+
+def read_cloud_mask(cloud_mask, cloud_flag, out=None, start=0, stop=MAX_HEIGHT):
+    """
+    :param cloud_mask, cloud_flag: as returned by open_cloud_mask
+    :param out: optional uint8 buffer of size (25, >= stop - start, >= WIDTH)
+    :param start, stop: range of swath rows to read and decode
+    :return: uint8 numpy.ndarray of size (25, rows, WIDTH), as decode_cloud_mask
+    """
+
+    stop = min(stop, MAX_HEIGHT)
+
+    cloud_mask = np.asarray(cloud_mask[start:stop, :MAX_WIDTH].values)
+    height, width = cloud_mask.shape
+
+    return decode_cloud_mask(cloud_mask, cloud_flag[0:4, start:start + height, 0:width], out)
+
+def decode_cloud_mask(cloud_mask, cloud_flag, out=None):
+    """
+    :param cloud_mask: the 2-bit cloud mask as read by satpy, numpy.ndarray of size (HEIGHT, WIDTH)
+    :param cloud_flag: the MYD35 Cloud_Mask SDS (or an array of size (6, HEIGHT, WIDTH)), of which the first 4 bytes are decoded
+    :param out: optional uint8 buffer of size (25, >= HEIGHT, >= WIDTH) the channels are written into
+    :return: uint8 numpy.ndarray of size (25, HEIGHT, WIDTH), the cloud mask followed by the 24 decoded flags, a view of out if it is given
+    """
+
+    height, width = cloud_mask.shape
+
+    if out is None:
+        out = np.empty((NB_MASK_CHANNELS, height, width), dtype=FLAG_DTYPE)
+
+    mask = out[:, :height, :width]
+
+    # pixels satpy could not read are NaN, which a cast to uint8 would turn into 0, a valid cloud mask value
+    cloud_mask = np.asarray(cloud_mask)
+    mask[0] = np.where(np.isnan(cloud_mask), FLAG_FILL_VALUE, np.nan_to_num(cloud_mask))
     
     # There are 6 bytes in the cloudmask:
 
@@ -57,10 +110,10 @@ def get_cloud_mask(l1_filename, cloud_mask_dir):
 #     " The left-most bit (bit 7) is the most significant bit.                   \n",
 #     " The right-most bit (bit 0) is the least significant bit.                 \n",
 #     "                                                                          \n",
-    maskVals1=cloud_flag[0,:,].astype(np.uint8)   #get the first byte
-    maskVals2=cloud_flag[1,:,].astype(np.uint8)   #get the second byte
-    maskVals3=cloud_flag[2,:,].astype(np.uint8)   #get the third byte
-    maskVals4=cloud_flag[3,:,].astype(np.uint8)   #get the fourth byte
+    maskVals1=cloud_flag[0,:height,:width].astype(np.uint8)   #get the first byte
+    maskVals2=cloud_flag[1,:height,:width].astype(np.uint8)   #get the second byte
+    maskVals3=cloud_flag[2,:height,:width].astype(np.uint8)   #get the third byte
+    maskVals4=cloud_flag[3,:height,:width].astype(np.uint8)   #get the fourth byte
     
 #     " bit field       Description                             Key              \n",
 #     " ---------       -----------                             ---              \n",
@@ -83,9 +136,9 @@ def get_cloud_mask(l1_filename, cloud_mask_dir):
 #     "                                                      11 = Land           \n",
 #     " ____ END BYTE 1 _________________________________________________________\n",    
     
-    Bit4 = bits_stripping(3,1,maskVals1)
-    Bit5 = bits_stripping(2,1,maskVals1)
-    Bit6_7 = bits_stripping(1,2,maskVals1)
+    Bit4 = bits_stripping(3,1,maskVals1,out=mask[1])
+    Bit5 = bits_stripping(2,1,maskVals1,out=mask[2])
+    Bit6_7 = bits_stripping(1,2,maskVals1,out=mask[3])
 #     "                                                                          \n",
 #     " bit field       Description                             Key              \n",
 #     " ---------       -----------                             ---              \n",
@@ -107,14 +160,14 @@ def get_cloud_mask(l1_filename, cloud_mask_dir):
 #     " 6               High Cloud Flag - CO2 Test              0 = Yes / 1 = No \n",
 #     " 7               High Cloud Flag - 6.7 micron Test       0 = Yes / 1 = No \n",
 #     " ____ END BYTE 2 _________________________________________________________\n",
-    Bit8 = bits_stripping(7,1,maskVals2)
-    Bit9 = bits_stripping(6,1,maskVals2)
-    Bit10 = bits_stripping(5,1,maskVals2)
-    Bit11 = bits_stripping(4,1,maskVals2)
-    Bit12 = bits_stripping(3,1,maskVals2)
-    Bit13 = bits_stripping(2,1,maskVals2)
-    Bit14 = bits_stripping(1,1,maskVals2)
-    Bit15 = bits_stripping(0,1,maskVals2)
+    Bit8 = bits_stripping(7,1,maskVals2,out=mask[4])
+    Bit9 = bits_stripping(6,1,maskVals2,out=mask[5])
+    Bit10 = bits_stripping(5,1,maskVals2,out=mask[6])
+    Bit11 = bits_stripping(4,1,maskVals2,out=mask[7])
+    Bit12 = bits_stripping(3,1,maskVals2,out=mask[8])
+    Bit13 = bits_stripping(2,1,maskVals2,out=mask[9])
+    Bit14 = bits_stripping(1,1,maskVals2,out=mask[10])
+    Bit15 = bits_stripping(0,1,maskVals2,out=mask[11])
 #     "                                                                          \n",
 #     " bit field       Description                             Key              \n",
 #     " ---------       -----------                             ---              \n",
@@ -131,14 +184,14 @@ def get_cloud_mask(l1_filename, cloud_mask_dir):
 #     "                              Confirmation Test                           \n",
 #     " 7               Cloud Flag - Night 7.3-11 micron Test   0 = Yes / 1 = No \n",
 #     " ____ END BYTE 3 _________________________________________________________\n",
-    Bit16 = bits_stripping(7,1,maskVals3)
-    Bit17 = bits_stripping(6,1,maskVals3)
-    Bit18 = bits_stripping(5,1,maskVals3)
-    Bit19 = bits_stripping(4,1,maskVals3)
-    Bit20 = bits_stripping(3,1,maskVals3)
-    Bit21 = bits_stripping(2,1,maskVals3)
-    Bit22 = bits_stripping(1,1,maskVals3)
-    Bit23 = bits_stripping(0,1,maskVals3)
+    Bit16 = bits_stripping(7,1,maskVals3,out=mask[12])
+    Bit17 = bits_stripping(6,1,maskVals3,out=mask[13])
+    Bit18 = bits_stripping(5,1,maskVals3,out=mask[14])
+    Bit19 = bits_stripping(4,1,maskVals3,out=mask[15])
+    Bit20 = bits_stripping(3,1,maskVals3,out=mask[16])
+    Bit21 = bits_stripping(2,1,maskVals3,out=mask[17])
+    Bit22 = bits_stripping(1,1,maskVals3,out=mask[18])
+    Bit23 = bits_stripping(0,1,maskVals3,out=mask[19])
 #     "                                                                          \n",
 #     " bit field       Description                             Key              \n",
 #     " ---------       -----------                             ---              \n",
@@ -154,14 +207,13 @@ def get_cloud_mask(l1_filename, cloud_mask_dir):
 #     "                                                                          \n",
 #     " 5-7             Spares                                                   \n",
 #     " ____ END BYTE 4 _________________________________________________________\n",
-    Bit24 = bits_stripping(7,1,maskVals4)
-    Bit25 = bits_stripping(6,1,maskVals4)
-    Bit26 = bits_stripping(5,1,maskVals4)
-    Bit27 = bits_stripping(4,1,maskVals4)
-    Bit28 = bits_stripping(3,1,maskVals4)
-    
-    mask =[cloud_mask, Bit4, Bit5, Bit6_7, Bit8, Bit9, Bit10, Bit11, Bit12, Bit13, Bit14, Bit15, Bit16, Bit17, Bit18, Bit19, Bit20, Bit21, Bit22, Bit23, Bit24, Bit25, Bit26, Bit27, Bit28]
+    Bit24 = bits_stripping(7,1,maskVals4,out=mask[20])
+    Bit25 = bits_stripping(6,1,maskVals4,out=mask[21])
+    Bit26 = bits_stripping(5,1,maskVals4,out=mask[22])
+    Bit27 = bits_stripping(4,1,maskVals4,out=mask[23])
+    Bit28 = bits_stripping(3,1,maskVals4,out=mask[24])
     
+    # mask holds [cloud_mask, Bit4, Bit5, Bit6_7, Bit8, ..., Bit28]
     
     return mask
 
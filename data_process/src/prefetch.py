@@ -0,0 +1,75 @@
+import queue
+import threading
+
+'''Background prefetching for batch runs: the inputs of the next items are loaded on a thread while the current item
+is processed, through a bounded queue that caps the number of loaded items held in memory.'''
+
+_END = object()
+
+def prefetch(items, load, depth=1):
+    """
+    :param items: iterable of items to load, e.g. MYD02 filenames
+    :param load: function loading the inputs of an item
+    :param depth: maximal number of loaded items waiting to be processed; 0 loads each item in the calling thread, when it is needed
+    :return: generator of (item, inputs, error) in the order of items, with error the exception raised by load(item), if any
+    """
+
+    if depth < 1:
+        return _load_inline(items, load)
+
+    return _load_ahead(items, load, depth)
+
+def _load(item, load):
+
+    try:
+        return item, load(item), None
+
+    except Exception as e:
+        return item, None, e
+
+def _load_inline(items, load):
+
+    for item in items:
+        yield _load(item, load)
+
+def _load_ahead(items, load, depth):
+
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+
+        try:
+            for item in items:
+
+                if stop.is_set():
+                    break
+
+                # blocks while depth loaded items are waiting
+                loaded.put(_load(item, load))
+
+        finally:
+            loaded.put(_END)
+
+    thread = threading.Thread(target=worker, name="prefetch", daemon=True)
+    thread.start()
+
+    try:
+        while True:
+
+            entry = loaded.get()
+
+            if entry is _END:
+                break
+
+            yield entry
+
+    finally:
+        # the consumer stopped early: let the worker finish its current item and exit
+        stop.set()
+
+        while thread.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -0,0 +1,66 @@
+import cProfile
+import json
+import os
+import time
+
+from contextlib import contextmanager
+
+'''Per-stage instrumentation: a granule record collects the wall time of each pipeline stage, and is appended as
+one JSON line per granule to a timings file. Selected stages can additionally be run under cProfile.'''
+
+def new_record(granule, profile_stages=(), profile_dir=None):
+    """
+    :param granule: name of the granule the record belongs to
+    :param profile_stages: names of the stages to run under cProfile
+    :param profile_dir: directory in which the .prof files are dumped, defaults to the working directory
+    :return: record dict, filled by stage()
+    """
+
+    return {"granule": granule, "stages": {}, "profile_stages": list(profile_stages), "profile_dir": profile_dir}
+
+@contextmanager
+def stage(record, name):
+    """
+    Times the enclosed block and adds it to record["stages"][name]. No-op if record is None.
+    If name is one of the record's profile stages, the block is profiled and the stats are dumped as <granule>.<name>.prof
+    """
+
+    if record is None:
+        yield
+        return
+
+    profiler = None
+
+    if name in record["profile_stages"]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    t1 = time.perf_counter()
+
+    try:
+        yield
+
+    finally:
+        t2 = time.perf_counter()
+
+        record["stages"][name] = record["stages"].get(name, 0.) + t2 - t1
+
+        if profiler is not None:
+            profiler.disable()
+
+            profile_dir = record["profile_dir"] or os.getcwd()
+            profiler.dump_stats(os.path.join(profile_dir, "{}.{}.prof".format(record["granule"], name)))
+
+def get_duration(record, name):
+    """ Returns the time spent in a stage so far, 0 if it was not run """
+
+    return 0. if record is None else record["stages"].get(name, 0.)
+
+def write_record(timings_path, record, **extra):
+    """ Appends the record as a single JSON line, with a timestamp, the total over all stages and any extra fields """
+
+    line = {"granule": record["granule"], "time": time.time(), "total": sum(record["stages"].values()), "stages": record["stages"]}
+    line.update(extra)
+
+    with open(timings_path, 'a') as f:
+        f.write(json.dumps(line) + "\n")
@@ -0,0 +1,69 @@
+import numpy as np
+
+from src.track_alignment import to_gnomonic, get_centre, points_in_polygon
+
+'''Region of interest of a training set, e.g. {"max_latitude": -60.} for the south of 60°S. A region is a dict with any of
+the keys "min_latitude", "max_latitude" (in degrees) and "polygon", a list of (latitude, longitude) vertices smaller than
+a hemisphere, whose edges are great circles rather than parallels; a point is in the region if it satisfies all of them.
+None stands for the whole globe.'''
+
+# number of points tested at once against a polygon, which bounds the (points, vertices) temporaries
+POLYGON_CHUNK = 2**16
+
+def in_region(latitudes, longitudes, region):
+    """
+    :param latitudes, longitudes: numpy.ndarray of any shape
+    :param region: region dict, or None
+    :return: boolean numpy.ndarray of the same shape, whether each point lies in the region
+    """
+
+    latitudes, longitudes = np.asarray(latitudes), np.asarray(longitudes)
+
+    inside = np.ones(latitudes.shape, dtype=bool)
+
+    if region is None:
+        return inside
+
+    if region.get("min_latitude") is not None:
+        inside &= latitudes >= region["min_latitude"]
+
+    if region.get("max_latitude") is not None:
+        inside &= latitudes <= region["max_latitude"]
+
+    if region.get("polygon") is not None:
+
+        polygon = np.asarray(region["polygon"], dtype=np.float64)
+        centre_latitude, centre_longitude = get_centre(polygon[:, 0], polygon[:, 1])
+        polygon_x, polygon_y, _ = to_gnomonic(polygon[:, 0], polygon[:, 1], centre_latitude, centre_longitude)
+
+        # only the points still inside are tested
+        candidates = np.flatnonzero(inside.ravel())
+        in_polygon = np.zeros(candidates.shape[0], dtype=bool)
+
+        for start in range(0, candidates.shape[0], POLYGON_CHUNK):
+
+            chunk = candidates[start:start + POLYGON_CHUNK]
+            x, y, visible = to_gnomonic(latitudes.ravel()[chunk], longitudes.ravel()[chunk], centre_latitude, centre_longitude)
+
+            in_polygon[start:start + POLYGON_CHUNK][visible] = points_in_polygon(x[visible], y[visible], polygon_x, polygon_y)
+
+        inside.ravel()[candidates] = in_polygon
+
+    return inside
+
+def get_region_rows(latitudes, longitudes, region, scan_rows=10):
+    """
+    :param latitudes, longitudes: swath geolocation, numpy.ndarray of size (HEIGHT, WIDTH)
+    :param scan_rows: the range is extended to whole scans, so that the interpolation of scan stripes is unchanged
+    :return start, stop: the range of rows holding a pixel of the region, (0, 0) if there is none
+    """
+
+    rows = np.flatnonzero(in_region(latitudes, longitudes, region).any(axis=1))
+
+    if rows.shape[0] == 0:
+        return 0, 0
+
+    start = rows[0] - rows[0] % scan_rows
+    stop = min(latitudes.shape[0], rows[-1] + scan_rows - rows[-1] % scan_rows)
+
+    return int(start), int(stop)
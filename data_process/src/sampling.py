@@ -0,0 +1,51 @@
+import numpy as np
+import zlib
+
+'''Subsampling of the co-located pixels at extraction time, so that the samples of the majority class (cloudy, over the
+Antarctic) that training would drop anyway are neither gathered nor written. A sampling policy is a dict with any of the keys:
+
+    "ratio": at most ratio samples of the majority class are kept per sample of the minority class, 1. for balanced classes;
+             a granule with samples of only one class (e.g. all cloudy) has nothing to balance and keeps them, up to max_samples
+    "max_samples": maximal number of samples kept per granule, drawn uniformly after the class ratio is applied
+    "seed": seed of the random draws, combined with the granule name so that a rerun keeps the same samples
+
+The class of a sample is whether a cloud was found in its cloudsat profile (layer info > 0). None keeps all the samples.'''
+
+def get_rng(policy, granule=""):
+    """ Returns the random generator of a granule, seeded by the policy seed and the granule name """
+
+    return np.random.default_rng([policy.get("seed", 0), zlib.crc32(granule.encode())])
+
+def get_sample_indices(layer_info, policy, granule=""):
+    """
+    :param layer_info: numpy.ndarray of size (nb_samples, 1), the cloud occurrences of the co-located pixels
+    :param policy: sampling policy dict, or None
+    :param granule: name of the granule, to draw different samples in each granule
+    :return: the sorted indices of the kept samples, which preserves their order along the track
+    """
+
+    nb_samples = len(layer_info)
+
+    if policy is None:
+        return np.arange(nb_samples)
+
+    rng = get_rng(policy, granule)
+
+    layer_info = np.asarray(layer_info)
+    cloudy = layer_info.any(axis=tuple(range(1, layer_info.ndim)))
+    classes = [np.flatnonzero(cloudy), np.flatnonzero(~cloudy)]
+
+    minority, majority = sorted(classes, key=len)
+
+    if policy.get("ratio") is not None and len(minority) > 0:
+
+        nb_majority = min(len(majority), int(policy["ratio"] * len(minority)))
+
+        classes = [minority, rng.choice(majority, nb_majority, replace=False)]
+
+    indices = np.concatenate(classes)
+
+    if policy.get("max_samples") is not None and len(indices) > policy["max_samples"]:
+        indices = rng.choice(indices, policy["max_samples"], replace=False)
+
+    return np.sort(indices)
@@ -3,7 +3,7 @@ import random
 
 from scipy.stats import mode
 from sklearn.metrics.pairwise import manhattan_distances
-from scipy.spatial import distance_matrix
+from scipy.spatial import cKDTree, distance_matrix
 from scipy.spatial.distance import pdist, cdist
 
 MAX_WIDTH, MAX_HEIGHT = 1354, 2040
@@ -83,33 +83,268 @@ def get_track_oi(cs_latitudes, cs_longitudes, swath_latitudes, swath_longitudes)
     
     return cs_range, data, modis_colocated_idx_dim_0, modis_colocated_idx_dim_1, cloudsat_idx
 
-def find_track_range(cs_latitudes, cs_longitudes, latitudes, longitudes):
+def to_cartesian(latitudes, longitudes):
+    """ Returns the points on the unit sphere, numpy.ndarray of size (nb_points, 3), in which distances are safe across the poles and the antimeridian """
 
-    i = MAX_HEIGHT // 2
+    lat, lon = np.deg2rad(np.ravel(latitudes)), np.deg2rad(np.ravel(longitudes))
 
-    i_lat, i_lon = latitudes[i-1:i+1, :], longitudes[i-1:i+1, :]
-    
-    print(i_lat, i_lon)
-    
-    i_indices = get_track_oi(cs_latitudes, cs_longitudes, i_lat, i_lon)
-    
-    i_mapping = scalable_align(cs_latitudes[i_indices], cs_longitudes[i_indices], i_lat, i_lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
 
-    min_j, max_j = min(i_mapping[1]), max(i_mapping[1])
-    
-    cs_range = (max(0, min_j), min(max_j, MAX_WIDTH - 1))
-    
-    return cs_range
 
+def get_grid_spacing(points):
+    """ Returns the largest distance between neighbouring points of a grid of points of size (height, width, 3), 0 for a single point """
+
+    spacings = [np.linalg.norm(np.diff(points, axis=axis), axis=-1) for axis in (0, 1) if points.shape[axis] > 1]
+
+    return max([spacing.max() for spacing in spacings], default=0.)
+
+
+def match_track(cs_points, latitudes, longitudes):
+    """
+    :param cs_points: cloudsat profiles on the unit sphere, as returned by to_cartesian
+    :param latitudes, longitudes: numpy.ndarray of size (height, width), a grid of swath pixels
+    :return: the indices of the profiles within a grid spacing of a pixel, and the row and column of their nearest pixel
+    """
+
+    points = to_cartesian(latitudes, longitudes).reshape(*latitudes.shape, 3)
+    spacing = get_grid_spacing(points)
+
+    # the bound stops the search early for the profiles away from the swath, most of the track
+    distances, nearest = cKDTree(points.reshape(-1, 3)).query(cs_points, distance_upper_bound=spacing * (1 + 1e-6))
+
+    matched = np.flatnonzero(np.isfinite(distances))
+    rows, cols = np.unravel_index(nearest[matched], latitudes.shape)
+
+    return matched, rows, cols
+
+
+def find_track_range(cs_latitudes, cs_longitudes, latitudes, longitudes, step=10, margin=2):
+    """
+    Coarse-to-fine search of the part of the swath crossed by the cloudsat track, e.g. to read only that window: the profiles
+    are first matched to every step-th row and column of the swath, then to the swath pixels around the coarse matches only
+    :param cs_latitudes, cs_longitudes: cloudsat track, numpy.ndarray of size (nb_points, 1) or (nb_points,)
+    :param latitudes, longitudes: swath geolocation, numpy.ndarray of size (HEIGHT, WIDTH)
+    :param margin: number of columns added on each side of the column band, as get_track_oi does
+    :return rows, cols, profiles: the (first, last) rows, columns and profile indices of the track in the swath, as half-open ranges;
+    None if the track does not cross the swath. The columns are swath columns (see get_swath_cols), those gather_track reads, so that
+    swath[:, rows[0]:rows[1], cols[0]:cols[1]] holds the track pixels
+    """
+
+    height, width = latitudes.shape
+    cs_points = to_cartesian(cs_latitudes, cs_longitudes)
+
+    # coarse: the profiles near the subsampled grid
+    matched, rows, cols = match_track(cs_points, latitudes[::step, ::step], longitudes[::step, ::step])
+
+    if matched.shape[0] == 0:
+        return None
+
+    # fine: the swath pixels within a coarse cell of the coarse matches, against the profiles around the coarse matches
+    first_row, last_row = max(0, (rows.min() - 1) * step), min(height, (rows.max() + 2) * step)
+    first_col, last_col = max(0, (cols.min() - 1) * step), min(width, (cols.max() + 2) * step)
+    first_profile, last_profile = max(0, matched.min() - step), min(cs_points.shape[0], matched.max() + step + 1)
+
+    matched, rows, cols = match_track(cs_points[first_profile:last_profile], latitudes[first_row:last_row, first_col:last_col], longitudes[first_row:last_row, first_col:last_col])
+
+    if matched.shape[0] == 0:
+        return None
+
+    rows, cols, profiles = rows + first_row, cols + first_col, matched + first_profile
+
+    # the band is mirrored into the columns the features are read at
+    first_col, last_col = get_swath_cols([cols.max() + margin, cols.min() - margin], width)
+
+    return (int(rows.min()), int(rows.max()) + 1), (max(0, int(first_col)), min(width, int(last_col) + 1)), (int(profiles.min()), int(profiles.max()) + 1)
 
-def map_labels(mapping, labels, shape):
 
-    labelmask = np.zeros((*shape, labels.shape[1]))
+def get_swath_cols(cols, width):
+    """
+    Returns the swath columns at which the features of the co-located pixels are read, from their columns as returned by get_track_oi.
+    gather_track, the strips and the label rasters all go through it, so that features and labels stay aligned
+    """
+
+    return width - np.asarray(cols)
+
+
+def gather_track(swath, rows, cols):
+    """
+    :param swath: numpy.ndarray of size (nb_channels, HEIGHT, WIDTH)
+    :param rows, cols: swath indices of the co-located pixels, as returned by get_track_oi
+    :return: numpy.ndarray of size (nb_channels, nb_pixels), the swath values along the track, with the dtype of the swath
+    """
+
+    return swath[:, np.asarray(rows), get_swath_cols(cols, swath.shape[2])]
+
+
+def get_strip_range(rows, cols, width, patch_size):
+    """
+    :param rows, cols: swath indices of the co-located pixels, as returned by get_track_oi
+    :param width: width of the swath
+    :param patch_size: size k of the k x k neighbourhoods kept around the co-located pixels
+    :return first_row, last_row, first_col, last_col: swath range of the cross-track strip holding all neighbourhoods, which can exceed the swath at its edges
+    """
+
+    half = patch_size // 2
+    rows, index = np.asarray(rows), get_swath_cols(cols, width)
+
+    return int(rows.min()) - half, int(rows.max()) + half + 1, int(index.min()) - half, int(index.max()) + half + 1
 
-    for i, l in enumerate(labels):
-        labelmask[mapping[0][i], mapping[1][i]] += l
 
-    return labelmask
+def get_patch_offsets(rows, cols, width, strip_range, patch_size):
+    """ Returns the strip indices of the upper left corner of the neighbourhood of each co-located pixel, centred as gather_track """
+
+    first_row, _, first_col, _ = strip_range
+    half = patch_size // 2
+
+    return np.asarray(rows) - half - first_row, get_swath_cols(cols, width) - half - first_col
+
+
+def new_strip(nb_channels, strip_range, dtype, fill_value):
+    """ Returns a strip of size (nb_channels, strip rows, strip columns) filled with fill_value, which is kept outside of the swath """
+
+    first_row, last_row, first_col, last_col = strip_range
+
+    return np.full((nb_channels, last_row - first_row, last_col - first_col), fill_value, dtype=dtype)
+
+
+def copy_to_strip(strip, strip_range, swath, first_row=0):
+    """
+    Copies the pixels of the swath that fall in the strip
+    :param swath: numpy.ndarray of size (nb_channels, rows, WIDTH), all the swath or a block of it starting at row first_row
+    """
+
+    strip_first_row, strip_last_row, strip_first_col, strip_last_col = strip_range
+
+    r0, r1 = max(strip_first_row, first_row), min(strip_last_row, first_row + swath.shape[1])
+    c0, c1 = max(strip_first_col, 0), min(strip_last_col, swath.shape[2])
+
+    if r0 < r1 and c0 < c1:
+        strip[:, r0 - strip_first_row:r1 - strip_first_row, c0 - strip_first_col:c1 - strip_first_col] = swath[:, r0 - first_row:r1 - first_row, c0:c1]
+
+
+def get_patch_windows(strip, patch_size):
+    """
+    :return: zero-copy view of size (rows, columns, nb_channels, k, k) of all k x k windows of the strip: the patch of a
+    co-located pixel is windows[row_offset, col_offset], a view of the strip, as returned by get_patch_offsets
+    """
+
+    windows = np.lib.stride_tricks.sliding_window_view(strip, (patch_size, patch_size), axis=(1, 2))
+
+    return windows.transpose(1, 2, 0, 3, 4)
+
+
+def get_patches(strip, row_offsets, col_offsets, patch_size):
+    """ Returns the (nb_pixels, nb_channels, k, k) patches of the co-located pixels, copied out of the strip, e.g. for a training batch """
+
+    return get_patch_windows(strip, patch_size)[row_offsets, col_offsets]
+
+
+def to_gnomonic(latitudes, longitudes, centre_latitude, centre_longitude):
+    """
+    Gnomonic projection on the plane tangent to the sphere at the centre, in which great circles are straight lines
+    :return x, y, visible: the projected coordinates, and whether each point lies on the hemisphere of the centre, the only points that can be projected
+    """
+
+    lat, lon = np.deg2rad(latitudes), np.deg2rad(longitudes)
+    lat0, lon0 = np.deg2rad(centre_latitude), np.deg2rad(centre_longitude)
+
+    cos_c = np.sin(lat0) * np.sin(lat) + np.cos(lat0) * np.cos(lat) * np.cos(lon - lon0)
+    visible = cos_c > 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.cos(lat) * np.sin(lon - lon0) / cos_c
+        y = (np.cos(lat0) * np.sin(lat) - np.sin(lat0) * np.cos(lat) * np.cos(lon - lon0)) / cos_c
+
+    return x, y, visible
+
+
+def get_centre(latitudes, longitudes):
+    """ Returns the latitude and longitude of the mean direction of the points, which is safe across the poles and the antimeridian """
+
+    lat, lon = np.deg2rad(latitudes), np.deg2rad(longitudes)
+
+    x, y, z = np.mean(np.cos(lat) * np.cos(lon)), np.mean(np.cos(lat) * np.sin(lon)), np.mean(np.sin(lat))
+
+    return np.rad2deg(np.arctan2(z, np.hypot(x, y))), np.rad2deg(np.arctan2(y, x))
+
+
+def points_in_polygon(x, y, polygon_x, polygon_y):
+    """ Even-odd rule: returns whether each point (x, y) lies inside the closed polygon """
+
+    x1, y1 = polygon_x[None, :], polygon_y[None, :]
+    x2, y2 = np.roll(polygon_x, -1)[None, :], np.roll(polygon_y, -1)[None, :]
+    x, y = x[:, None], y[:, None]
+
+    # edges crossed by the horizontal ray going right from each point
+    straddles = (y1 > y) != (y2 > y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = straddles & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+
+    return np.logical_xor.reduce(crossings, axis=1)
+
+
+def track_intersects_swath(cs_latitudes, cs_longitudes, edge_latitudes, edge_longitudes):
+    """
+    :param cs_latitudes, cs_longitudes: profiles of the cloudsat track, numpy.ndarray of size (nb_points,)
+    :param edge_latitudes, edge_longitudes: outline of the swath, as returned by src.modis_level1.get_edge_geolocation
+    :return: whether any profile falls inside the swath
+    """
+
+    if len(cs_latitudes) == 0 or len(edge_latitudes) < 3:
+        return False
+
+    centre_latitude, centre_longitude = get_centre(edge_latitudes, edge_longitudes)
+
+    polygon_x, polygon_y, _ = to_gnomonic(edge_latitudes, edge_longitudes, centre_latitude, centre_longitude)
+    x, y, visible = to_gnomonic(cs_latitudes, cs_longitudes, centre_latitude, centre_longitude)
+
+    return bool(np.any(points_in_polygon(x[visible], y[visible], polygon_x, polygon_y)))
+
+
+def map_labels(mapping, labels, shape, mode="max", col_range=None):
+    """
+    Rasterizes the labels of the co-located pixels, e.g. for segmentation, at the swath pixels whose features gather_track reads for them.
+    Several cloudsat profiles can fall in the same swath pixel: their labels are combined according to mode
+    :param mapping: numpy.ndarray of size (nb_pixels, 3), the swath row, swath column and cloudsat profile index of each label, as returned by get_track_oi
+    :param labels: numpy.ndarray of size (nb_pixels, nb_labels) or (nb_pixels,), non-negative integers
+    :param shape: (HEIGHT, WIDTH) of the swath
+    :param mode: "max", "sum" (clipped to 255) or "mean" (rounded) of the labels falling in a pixel
+    :param col_range: optional (first, last) swath columns of the raster (see get_swath_cols), e.g. those of a strip, for a raster of the track window only
+    :return: uint8 numpy.ndarray of size (nb_labels, HEIGHT, WIDTH or last - first), 0 where there is no label
+    """
+
+    mapping = np.asarray(mapping).reshape(-1, 3)
+    labels = np.asarray(labels).reshape(mapping.shape[0], -1).astype(np.int64)
+
+    height, width = shape
+    rows, cols = mapping[:, 0].astype(np.int64), get_swath_cols(mapping[:, 1].astype(np.int64), width)
+
+    if col_range is not None:
+        cols, width = cols - col_range[0], col_range[1] - col_range[0]
+
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    pixels, labels = rows[inside] * width + cols[inside], labels[inside]
+
+    nb_labels = labels.shape[1]
+    raster = np.zeros((nb_labels, height * width), dtype=np.int64)
+
+    if mode == "max":
+        np.maximum.at(raster, (np.repeat(np.arange(nb_labels)[None], pixels.shape[0], axis=0), pixels[:, None]), labels)
+
+    elif mode in ("sum", "mean"):
+
+        for i in range(nb_labels):
+            raster[i] = np.bincount(pixels, weights=labels[:, i], minlength=height * width)
+
+        if mode == "mean":
+            counts = np.bincount(pixels, minlength=height * width)
+            raster = np.round(raster / np.maximum(counts, 1)).astype(np.int64)
+
+    else:
+        raise ValueError("unknown label combination mode {}".format(mode))
+
+    return np.clip(raster, 0, 255).astype(np.uint8).reshape(nb_labels, height, width)
 
 
 #if __name__ == "__main__":
@@ -133,3 +368,16 @@ def map_labels(mapping, labels, shape):
     #labels = map_labels(mapping, np.array(test_track[2])[:, None], (5, 3))
 
     #print(labels)
+
+
+if __name__ == "__main__":
+
+    # labels are rasterized at the pixels whose features are gathered for them
+    test_swath = np.arange(5 * 7, dtype=np.float32).reshape(1, 5, 7)
+    test_mapping = np.array([[0, 1, 0], [2, 3, 1], [4, 6, 2]])
+
+    test_labels = map_labels(test_mapping, np.array([1, 1, 1]), test_swath.shape[1:])
+    assert np.array_equal(test_swath[test_labels > 0], gather_track(test_swath, test_mapping[:, 0], test_mapping[:, 1])[0])
+
+    test_window = map_labels(test_mapping, np.array([1, 1, 1]), test_swath.shape[1:], col_range=(1, 5))
+    assert np.array_equal(test_window, test_labels[:, :, 1:5])
@@ -1,4 +1,14 @@
 import datetime
+import numpy as np
+
+# dtype policy of the swath pipeline: radiances, reflectances and angles as float32, geolocation as float32,
+# and flags, categorical masks and labels as uint8
+RADIANCE_DTYPE = np.float32
+GEOLOCATION_DTYPE = np.float32
+FLAG_DTYPE = np.uint8
+
+# fill value of the flags outside of the swath, out of the valid range of all of them
+FLAG_FILL_VALUE = 255
 
 def get_datetime(year, day, hour=0, minute=0, second=0):
     """ Returns month and day given a day of a year"""
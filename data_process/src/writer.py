@@ -0,0 +1,100 @@
+import multiprocessing
+import queue
+import time
+
+'''Background writing of the outputs: the compute process hands the finished arrays of each granule to dedicated writer
+processes through a bounded queue, and goes on with the next granule while they compress and write. Submitting blocks
+while the queue is full, which bounds the finished outputs held in memory when the writers fall behind. The outcome of
+each write is sent back, so that a granule is only recorded as done once its output is on disk.'''
+
+_STOP = None
+
+def start_writers(write, nb_writers=1, depth=2):
+    """
+    :param write: module-level function run by the writers as write(*args, **kwargs), e.g. netcdf.npy_to_nc.save_as_nc
+    :param nb_writers: number of writer processes
+    :param depth: maximal number of outputs waiting to be written
+    :return: writers dict, passed to submit, get_results and stop_writers
+    """
+
+    # the compute process runs threads (prefetching), which forking would copy in an arbitrary state
+    context = multiprocessing.get_context("spawn")
+
+    jobs = context.Queue(maxsize=depth)
+    results = context.Queue()
+
+    processes = [context.Process(target=_write_loop, args=(write, jobs, results), name="writer-{}".format(i), daemon=True) for i in range(nb_writers)]
+
+    for process in processes:
+        process.start()
+
+    return {"jobs": jobs, "results": results, "processes": processes, "pending": 0}
+
+def _write_loop(write, jobs, results):
+
+    while True:
+
+        job = jobs.get()
+
+        if job is _STOP:
+            break
+
+        key, args, kwargs = job
+
+        t1 = time.perf_counter()
+
+        try:
+            write(*args, **kwargs)
+            error = None
+
+        except Exception as e:
+            # sent as a string, as exceptions are not all picklable
+            error = "{}: {}".format(type(e).__name__, e)
+
+        results.put((key, time.perf_counter() - t1, error))
+
+def submit(writers, key, *args, **kwargs):
+    """
+    Queues write(*args, **kwargs), blocking while depth outputs are already waiting. The arguments are pickled to the writer.
+    :param key: picklable identifier of the output, returned with its outcome by get_results
+    """
+
+    writers["jobs"].put((key, args, kwargs))
+    writers["pending"] += 1
+
+def get_results(writers, wait=False):
+    """
+    :param wait: if True, blocks until all the submitted outputs are written
+    :return: list of (key, write time in seconds, error message or None) of the outputs written since the last call
+    """
+
+    finished = []
+
+    while writers["pending"] > 0:
+
+        try:
+            finished.append(writers["results"].get(timeout=1.) if wait else writers["results"].get_nowait())
+            writers["pending"] -= 1
+
+        except queue.Empty:
+
+            if not wait:
+                break
+
+            if not any(process.is_alive() for process in writers["processes"]):
+                raise RuntimeError("the writer processes exited with {} outputs not written".format(writers["pending"]))
+
+    return finished
+
+def stop_writers(writers):
+    """ Waits for the submitted outputs to be written, stops the writers and returns the remaining results, as get_results """
+
+    finished = get_results(writers, wait=True)
+
+    for _ in writers["processes"]:
+        writers["jobs"].put(_STOP)
+
+    for process in writers["processes"]:
+        process.join()
+
+    return finished